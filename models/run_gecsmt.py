@@ -6,97 +6,1220 @@ import sys
 import argparse
 import yaml
 import re
+import copy
+import json
+import resource
+import contextlib
+import gzip
+import heapq
+import itertools
+import multiprocessing
+import sqlite3
+import hashlib
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import SocketServer
 
 MOSES = "/data/smt/mosesdecoder"
 LAZY = "/data/smt/lazy"
 SCRIPTS = "/work/gec/repos/baselines-emnlp2016/train/scripts"
 THREADS = 16
 
+PROFILE = None
+
+# processes of all running pipelines, so that a failing shard can stop the
+# others
+RUNNING = set()
+RUNNING_LOCK = threading.Lock()
+ABORTED = threading.Event()
+
 
 def main():
+    global PROFILE
     args = parse_user_args()
+    start = time.time()
 
     LM, WC, use_sparse = parse_config_ini(args.config)
 
-    TOK = "{}/scripts/tokenizer/tokenizer.perl".format(args.moses)
-    DETOK = "{}/scripts/tokenizer/detokenizer.perl".format(args.moses)
-
-    TC = "{}/case_graph.perl --lm {} --decode {}/bin/decode" \
-        .format(args.scripts, LM, args.lazy)
+    # python modules from train/scripts are used in-process
+    sys.path.append(args.scripts)
+    sys.path.append(os.path.join(args.scripts, "m2_tok"))
 
     # set up working directory
     if not os.path.exists(args.workdir):
         os.makedirs(args.workdir)
+
+    if args.server:
+        run_server(args, LM, WC, use_sparse)
+        return
+
     base = os.path.splitext(os.path.basename(args.input))[0]
     prefix = os.path.join(args.workdir, base)
 
+    if args.profile:
+        PROFILE = Profile()
+
     # get text to be corrected
     if args.m2:
-        run_cmd("grep '^S' {f} | cut -c3- > {pfx}.in" \
-            .format(f=args.input, pfx=prefix))
+        run_stages([("extract", "grep '^S' {} | cut -c3-".format(args.input))],
+                   output="{}.in".format(prefix))
+    else:
+        run_stages([("extract", "cat {}".format(args.input))],
+                   output="{}.in".format(prefix))
+
+    if args.chunk_size:
+        run_chunked(args, prefix, LM, WC, use_sparse)
+    else:
+        correct_input(args, prefix, LM, WC, use_sparse)
+
+    if args.output:
+        run_cmd("cp {pfx}.out {out}".format(pfx=prefix, out=args.output))
+
+    # evaluate if possible
+    if args.m2 and not args.nbest:
+        run_stages([("evaluate", "{}/m2scorer_fork {}.out {}"
+                     .format(args.scripts, prefix, args.input))],
+                   output="{}.eval".format(prefix))
+        with open("{}.eval".format(prefix)) as eval_io:
+            print eval_io.read().strip()
+
+    if PROFILE:
+        PROFILE.write("{}.profile.json".format(prefix), args,
+                      time.time() - start)
+        if args.profile_summary:
+            PROFILE.print_summary()
+
+
+def correct_input(args, prefix, lm, wc, use_sparse):
+    if args.dedup:
+        run_deduplicated(args, prefix, lm, wc, use_sparse)
+    elif args.cache:
+        run_cached(args, prefix, lm, wc, use_sparse)
     else:
-        run_cmd("cp {f} {pfx}.in".format(f=args.input, pfx=prefix))
+        correct_file(args, prefix, lm, wc, use_sparse)
 
+
+def correct_file(args, prefix, lm, wc, use_sparse):
+    if args.shards > 1:
+        run_sharded(args, prefix, lm, wc, use_sparse)
+    elif args.stream:
+        run_streaming(args, prefix, lm, wc, use_sparse)
+    else:
+        run_pipeline(args, prefix, lm, wc, use_sparse)
+
+
+def run_pipeline(args, prefix, lm, wc, use_sparse):
+    """Corrects {prefix}.in into {prefix}.out stage by stage, keeping all
+    intermediate files in the working directory."""
     # tokenize and truecase
-    run_cmd("{scripts}/m2_tok/detokenize.py < {pfx}.in " \
-            " | {tok} -threads {th} | {tc} > {pfx}.in.tok"
-        .format(pfx=prefix, scripts=args.scripts, tok=TOK, th=args.threads, tc=TC))
+    run_stages(preprocess_stages(args, lm), "{}.in".format(prefix),
+               "{}.in.tok".format(prefix))
 
     # models with sparse features assume WC factored input
     if use_sparse:
         run_cmd("mv {pfx}.in.tok {pfx}.in.tok.nowc".format(pfx=prefix))
-        run_cmd("perl {scripts}/anottext.pl -f {wc}" \
-                " < {pfx}.in.tok.nowc > {pfx}.in.tok" \
-            .format(scripts=args.scripts, wc=WC, pfx=prefix))
+        run_stages([("word classes", word_classes_cmd(args, wc))],
+                   "{}.in.tok.nowc".format(prefix), "{}.in.tok".format(prefix))
 
     # run Moses
     if args.nbest is not None:
-        run_cmd("{moses}/bin/moses -f {ini}" \
-                " -n-best-list - {nbest} distinct" \
-                " -print-alignment-info-in-n-best " \
-                " -labeled-n-best-list false " \
-                " -threads {th} -fd '|'" \
-                " < {pfx}.in.tok > {pfx}.out.tok.nbest" \
-            .format(moses=args.moses, ini=args.config, pfx=prefix,
-                    th=args.threads, nbest=args.nbest))
-
-        extract_text_and_alignment(
-            "{}.out.tok.nbest".format(prefix), "{}.in".format(prefix),
-            "{}.out.tok".format(prefix), "{}.out.tok.aln".format(prefix),
-            "{}.in.nbest".format(prefix))
+        run_stages([("moses", moses_cmd(args, nbest_options(args)))],
+                   "{}.in.tok".format(prefix),
+                   "{}.out.tok.nbest".format(prefix))
+
+        if args.postprocessor == "python":
+            print >> sys.stderr, "Restoring casing and tokenization" \
+                " of n-best list"
+            with profile_stage("postprocess",
+                               "{}.out.tok.nbest".format(prefix),
+                               "{}.out".format(prefix)), \
+                    open("{}.out.tok.nbest".format(prefix)) as nbest_io, \
+                    open("{}.in".format(prefix)) as orig_io, \
+                    open("{}.out".format(prefix), 'w') as out_io:
+                impose_nbest(nbest_io, orig_io, out_io, args.threads)
+            return
+
+        with profile_stage("extract n-best", "{}.out.tok.nbest".format(prefix),
+                           "{}.out.tok".format(prefix)):
+            extract_text_and_alignment(
+                "{}.out.tok.nbest".format(prefix), "{}.in".format(prefix),
+                "{}.out.tok".format(prefix), "{}.out.tok.aln".format(prefix),
+                "{}.in.nbest".format(prefix))
 
         run_cmd("cp {pfx}.in {pfx}.in.bac".format(pfx=prefix))
         run_cmd("mv {pfx}.in.nbest {pfx}.in".format(pfx=prefix))
     else:
-        run_cmd("{moses}/bin/moses -f {ini}" \
-                " --alignment-output-file {pfx}.out.tok.aln -threads {th} -fd '|'" \
-                " < {pfx}.in.tok > {pfx}.out.tok" \
-            .format(moses=args.moses, ini=args.config, pfx=prefix, th=args.threads))
+        run_stages([("moses", moses_cmd(
+                        args, "--alignment-output-file {}.out.tok.aln"
+                              .format(prefix)))],
+                   "{}.in.tok".format(prefix), "{}.out.tok".format(prefix))
 
     # restore casing and tokenization
-    run_cmd("cat {pfx}.out.tok" \
-            " | {scripts}/impose_case.perl {pfx}.in {pfx}.out.tok.aln" \
-            " | {moses}/scripts/tokenizer/deescape-special-chars.perl" \
-            " | {scripts}/impose_tok.perl {pfx}.in > {pfx}.out" \
-        .format(pfx=prefix, scripts=args.scripts, moses=args.moses))
+    run_stages(postprocess_stages(args, "{}.in".format(prefix),
+                                  "{}.out.tok.aln".format(prefix)),
+               "{}.out.tok".format(prefix), "{}.out".format(prefix))
 
     if args.nbest:
-        reconstruct_nbest_list("{}.out.tok.nbest".format(prefix),
-                               "{}.out".format(prefix),
-                               "{}.out.nbest".format(prefix))
+        with profile_stage("reconstruct n-best", "{}.out".format(prefix),
+                           "{}.out.nbest".format(prefix)):
+            reconstruct_nbest_list("{}.out.tok.nbest".format(prefix),
+                                   "{}.out".format(prefix),
+                                   "{}.out.nbest".format(prefix))
 
         run_cmd("cp {pfx}.out {pfx}.out.bac".format(pfx=prefix))
         run_cmd("mv {pfx}.out.nbest {pfx}.out".format(pfx=prefix))
 
-    if args.output:
-        run_cmd("cp {pfx}.out {out}".format(pfx=prefix, out=args.output))
 
-    # evaluate if possible
-    if args.m2 and not args.nbest:
-        run_cmd("{scripts}/m2scorer_fork {pfx}.out {f} > {pfx}.eval" \
-            .format(scripts=args.scripts, pfx=prefix, f=args.input))
-        with open("{}.eval".format(prefix)) as eval_io:
-            print eval_io.read().strip()
+def run_streaming(args, prefix, lm, wc, use_sparse):
+    """Corrects {prefix}.in into {prefix}.out with all stages connected by
+    pipes, so that no intermediate files are written and the stages run
+    concurrently. Alignments are passed to impose_case.perl through a named
+    pipe. Any stage exiting with a non-zero code aborts the whole run."""
+    front_stages = preprocess_stages(args, lm)
+    if use_sparse:
+        front_stages.append(("word classes", word_classes_cmd(args, wc)))
+    lines = count_lines("{}.in".format(prefix)) if PROFILE else None
+
+    if args.nbest is not None:
+        if args.postprocessor != "python":
+            print >> sys.stderr, "Streaming n-best lists requires" \
+                " --postprocessor python"
+            exit(1)
+        front_stages.append(("moses", moses_cmd(args, nbest_options(args))))
+        for _, cmd in front_stages:
+            print >> sys.stderr, "Run:", cmd
+        start = time.time()
+        with open("{}.in".format(prefix)) as in_io:
+            front = start_pipeline([cmd for _, cmd in front_stages],
+                                   in_io, subprocess.PIPE)
+
+        failed = []
+
+        def consume():
+            try:
+                with open("{}.in".format(prefix)) as orig_io, \
+                        open("{}.out".format(prefix), 'w') as out_io:
+                    impose_nbest(front[-1].stdout, orig_io, out_io,
+                                 args.threads)
+            except Exception as exc:
+                # nothing reads Moses' output any more, so stop the pipeline
+                print >> sys.stderr, "Post-processing n-best list failed:", \
+                    exc
+                failed.append(exc)
+                for proc in front:
+                    if proc.returncode is None:
+                        try:
+                            proc.kill()
+                        except OSError:
+                            pass
+
+        consumer = threading.Thread(target=consume)
+        consumer.daemon = True
+        consumer.start()
+        usages = wait_pipeline(front, front_stages)
+        consumer.join()
+        if failed:
+            exit(1)
+        if PROFILE:
+            for (name, cmd), usage in zip(front_stages, usages):
+                PROFILE.add(name, cmd, lines_in=lines, streamed=True, **usage)
+            PROFILE.add("postprocess", "impose_nbest()",
+                        wall=time.time() - start, lines_in=lines,
+                        lines_out=count_lines("{}.out".format(prefix)),
+                        streamed=True)
+        return
+
+    front_stages.append(("moses", moses_cmd(args, "-print-alignment-info")))
+
+    fifo = "{}.out.tok.aln.fifo".format(prefix)
+    if os.path.exists(fifo):
+        os.remove(fifo)
+    os.mkfifo(fifo)
+    back_stages = postprocess_stages(args, "{}.in".format(prefix), fifo)
+    stages = front_stages + back_stages
+
+    for _, cmd in stages:
+        print >> sys.stderr, "Run:", cmd
+
+    try:
+        with open("{}.in".format(prefix)) as in_io, \
+                open("{}.out".format(prefix), 'w') as out_io:
+            front = start_pipeline([cmd for _, cmd in front_stages],
+                                   in_io, subprocess.PIPE)
+            back = start_pipeline([cmd for _, cmd in back_stages],
+                                  subprocess.PIPE, out_io)
+
+        splitter = threading.Thread(
+            target=split_alignment,
+            args=(front[-1].stdout, back[0].stdin, fifo))
+        splitter.daemon = True
+        splitter.start()
+
+        usages = wait_pipeline(front + back, stages)
+        splitter.join()
+    finally:
+        os.remove(fifo)
+
+    if PROFILE:
+        lines_out = count_lines("{}.out".format(prefix))
+        for i, ((name, cmd), usage) in enumerate(zip(stages, usages)):
+            PROFILE.add(name, cmd, lines_in=lines,
+                        lines_out=lines_out if i == len(stages) - 1 else None,
+                        streamed=True, **usage)
+
+
+def start_pipeline(cmds, stdin, stdout):
+    """Starts shell commands connected with pipes."""
+    procs = []
+    for i, cmd in enumerate(cmds):
+        out = stdout if i == len(cmds) - 1 else subprocess.PIPE
+        with RUNNING_LOCK:
+            if ABORTED.is_set():
+                exit(1)
+            # exec, so that kill() stops the command and not only the shell
+            proc = subprocess.Popen("exec " + cmd, shell=True, stdin=stdin,
+                                    stdout=out)
+            RUNNING.add(proc)
+        if procs and procs[-1].stdout:
+            # let the previous stage receive SIGPIPE if this one dies
+            procs[-1].stdout.close()
+        stdin = proc.stdout
+        procs.append(proc)
+    return procs
+
+
+def wait_pipeline(procs, stages):
+    """Waits for all processes and kills the remaining ones as soon as one
+    of them fails. Returns wall time, CPU time and peak memory of each
+    process, including its children."""
+    start = time.time()
+    usages = [None] * len(procs)
+    running = list(procs)
+    while running:
+        for proc in list(running):
+            with RUNNING_LOCK:
+                pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+                if pid != 0:
+                    RUNNING.discard(proc)
+            if pid == 0:
+                continue
+            running.remove(proc)
+            if os.WIFSIGNALED(status):
+                proc.returncode = -os.WTERMSIG(status)
+            else:
+                proc.returncode = os.WEXITSTATUS(status)
+            usages[procs.index(proc)] = {
+                'wall': time.time() - start,
+                'cpu': usage.ru_utime + usage.ru_stime,
+                'max_rss': usage.ru_maxrss,
+            }
+            if proc.returncode != 0:
+                for other in running:
+                    other.kill()
+                if ABORTED.is_set():
+                    # killed by abort_pipelines(), the failing shard
+                    # reports its own error
+                    exit(1)
+                print >> sys.stderr, "Command failed with exit code {}: {}" \
+                    .format(proc.returncode, stages[procs.index(proc)][1])
+                exit(1)
+        time.sleep(0.01)
+    return usages
+
+
+def abort_pipelines():
+    """Kills the processes of all running pipelines and keeps new ones from
+    starting."""
+    with RUNNING_LOCK:
+        ABORTED.set()
+        for proc in RUNNING:
+            try:
+                proc.kill()
+            except OSError:
+                pass
+
+
+def run_stages(stages, input=None, output=None):
+    """Runs (name, command) stages connected with pipes, reading from and
+    writing to the given files, and adds named stages to the profile."""
+    cmd = " | ".join(cmd for _, cmd in stages)
+    if input:
+        cmd += " < {}".format(input)
+    if output:
+        cmd += " > {}".format(output)
+    print >> sys.stderr, "Run:", cmd
+
+    in_io = open(input) if input else None
+    out_io = open(output, 'w') if output else None
+    try:
+        procs = start_pipeline([cmd for _, cmd in stages], in_io, out_io)
+    finally:
+        for io in (in_io, out_io):
+            if io:
+                io.close()
+    usages = wait_pipeline(procs, stages)
+
+    if PROFILE:
+        lines_in = count_lines(input) if input else None
+        lines_out = count_lines(output) if output else None
+        for i, ((name, cmd), usage) in enumerate(zip(stages, usages)):
+            if name is None:
+                continue
+            PROFILE.add(name, cmd, lines_in=lines_in,
+                        lines_out=lines_out if i == len(stages) - 1 else None,
+                        streamed=len(stages) > 1, **usage)
+
+
+@contextlib.contextmanager
+def profile_stage(name, input=None, output=None):
+    """Adds a stage run in this process (and its worker processes) to the
+    profile."""
+    if not PROFILE:
+        yield
+        return
+    start = time.time()
+    self_start = resource.getrusage(resource.RUSAGE_SELF)
+    children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    yield
+    self_end = resource.getrusage(resource.RUSAGE_SELF)
+    children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = sum(end.ru_utime + end.ru_stime - begin.ru_utime - begin.ru_stime
+              for begin, end in ((self_start, self_end),
+                                 (children_start, children_end)))
+    PROFILE.add(name, "(in-process)", wall=time.time() - start, cpu=cpu,
+                max_rss=max(self_end.ru_maxrss, children_end.ru_maxrss),
+                lines_in=count_lines(input) if input else None,
+                lines_out=count_lines(output) if output else None)
+
+
+class Profile(object):
+    """Collects wall time, CPU time, peak memory and line counts of the
+    stages of a run, and writes them as a JSON report."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = []
+
+    def add(self, name, cmd, wall, cpu=None, max_rss=None, lines_in=None,
+            lines_out=None, streamed=False):
+        lines = lines_in if lines_in is not None else lines_out
+        stage = {
+            'stage': name,
+            'command': cmd,
+            'thread': threading.current_thread().name,
+            'wall_time': round(wall, 3),
+            'cpu_time': round(cpu, 3) if cpu is not None else None,
+            'max_rss_kb': max_rss,
+            'lines_in': lines_in,
+            'lines_out': lines_out,
+            'lines_per_sec': round(lines / wall, 2)
+            if lines is not None and wall > 0 else None,
+            'streamed': streamed,
+        }
+        with self.lock:
+            self.stages.append(stage)
+
+    def write(self, path, args, total_time):
+        report = {
+            'config': os.path.abspath(args.config),
+            'model': config_name(args.config),
+            'input': os.path.abspath(args.input),
+            'threads': args.threads,
+            'shards': args.shards,
+            'stream': args.stream,
+            'nbest': args.nbest,
+            'tokenizer': args.tokenizer,
+            'truecaser': args.truecaser,
+            'postprocessor': args.postprocessor,
+            'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'total_wall_time': round(total_time, 3),
+            'stages': self.stages,
+        }
+        with open(path, 'w') as json_io:
+            json.dump(report, json_io, indent=2, sort_keys=True)
+        print >> sys.stderr, "Profile written to {}".format(path)
+
+    def print_summary(self):
+        print >> sys.stderr, "{:<20} {:>10} {:>10} {:>12} {:>10} {:>10} " \
+            "{:>10}".format("stage", "wall (s)", "cpu (s)", "max rss (MB)",
+                            "lines in", "lines out", "lines/s")
+
+        def fmt(value, pattern="{}"):
+            return "-" if value is None else pattern.format(value)
+
+        for stage in self.stages:
+            name = stage['stage']
+            if stage['thread'] != "MainThread":
+                name = "{}/{}".format(stage['thread'], name)
+            print >> sys.stderr, "{:<20} {:>10} {:>10} {:>12} {:>10} {:>10} " \
+                "{:>10}".format(
+                    name[:20], fmt(stage['wall_time'], "{:.2f}"),
+                    fmt(stage['cpu_time'], "{:.2f}"),
+                    fmt(stage['max_rss_kb'] and stage['max_rss_kb'] / 1024.0,
+                        "{:.1f}"),
+                    fmt(stage['lines_in']), fmt(stage['lines_out']),
+                    fmt(stage['lines_per_sec'], "{:.1f}"))
+
+
+def config_name(config):
+    """Model configuration name, e.g. 'sparse-cclm' for
+    moses.sparse-cclm.mert.avg.ini."""
+    name = os.path.basename(config)
+    match = re.match(r'moses\.(.+?)\.mert', name)
+    return match.group(1) if match else name
+
+
+def count_lines(path):
+    with open(path) as io:
+        return sum(1 for _ in io)
+
+
+def split_alignment(moses_io, text_io, aln_path):
+    """Splits Moses output with inline alignments into text written to the
+    given stream and alignments written to the given path."""
+    try:
+        with open(aln_path, 'w') as aln_io:
+            for line in iter(moses_io.readline, ""):
+                text, _, aln = line.rstrip("\n").partition(" ||| ")
+                # impose_case.perl reads text and alignments in lockstep, so
+                # each alignment is flushed together with its text line;
+                # batching them could fill the fifo buffer and deadlock
+                aln_io.write(aln.strip() + "\n")
+                aln_io.flush()
+                text_io.write(text.strip() + "\n")
+                text_io.flush()
+    except IOError as exc:
+        print >> sys.stderr, "Error:", exc
+    finally:
+        try:
+            text_io.close()
+        except IOError:
+            pass
+
+
+def run_chunked(args, prefix, lm, wc, use_sparse):
+    """Corrects {prefix}.in in chunks of fixed size. Completed chunks are
+    recorded in a manifest in {prefix}.chunks/, so that a restarted job
+    skips them. Chunk outputs are concatenated once all chunks are done."""
+    chunk_dir = "{}.chunks".format(prefix)
+    manifest = os.path.join(chunk_dir, "manifest")
+
+    with open("{}.in".format(prefix)) as in_io:
+        lines = in_io.readlines()
+    sha = hashlib.sha1(config_hash(args, lm))
+    sha.update("chunk_size={}".format(args.chunk_size))
+    for line in lines:
+        sha.update(line)
+    key = sha.hexdigest()
+
+    done = read_manifest(manifest, key)
+    if done is None:
+        if os.path.exists(chunk_dir):
+            print >> sys.stderr, "Input or configuration changed," \
+                " discarding {}".format(chunk_dir)
+            shutil.rmtree(chunk_dir)
+        os.makedirs(chunk_dir)
+        with open(manifest, 'w') as manifest_io:
+            manifest_io.write("key {}\n".format(key))
+        done = set()
+
+    chunks = [range(i, min(i + args.chunk_size, len(lines)))
+              for i in xrange(0, len(lines), args.chunk_size)]
+    prefixes = [os.path.join(chunk_dir, "chunk{:05d}".format(k))
+                for k in range(len(chunks))]
+    if done:
+        print >> sys.stderr, "Resuming: {} of {} chunks already done" \
+            .format(len(done), len(chunks))
+
+    chunk_args = copy.copy(args)
+    chunk_args.chunk_size = None
+    start = time.time()
+    decoded = 0
+    remaining = sum(len(idxs) for k, idxs in enumerate(chunks)
+                    if k not in done)
+
+    for k, idxs in enumerate(chunks):
+        if k in done:
+            continue
+        chunk_start = time.time()
+        with open("{}.in".format(prefixes[k]), 'w') as chunk_io:
+            for i in idxs:
+                chunk_io.write(lines[i])
+        correct_input(chunk_args, prefixes[k], lm, wc, use_sparse)
+        elapsed = time.time() - chunk_start
+
+        with open(manifest, 'a') as manifest_io:
+            manifest_io.write("done {} {} {:.3f}\n"
+                              .format(k, len(idxs), elapsed))
+            manifest_io.flush()
+            os.fsync(manifest_io.fileno())
+        done.add(k)
+
+        decoded += len(idxs)
+        remaining -= len(idxs)
+        rate = decoded / max(time.time() - start, 1e-6)
+        print >> sys.stderr, "Chunk {}/{} done in {:.1f}s ({:.2f} sents/s)," \
+            " {}/{} chunks finished, ETA {}".format(
+                k + 1, len(chunks), elapsed, len(idxs) / max(elapsed, 1e-6),
+                len(done), len(chunks), format_duration(remaining / rate))
+
+    suffixes = [".out"]
+    if args.nbest is None:
+        suffixes.append(".out.tok.aln")
+    else:
+        suffixes.append(".out.tok.nbest")
+    for suffix in suffixes:
+        paths = [p + suffix for p in prefixes]
+        if all(os.path.exists(p) for p in paths):
+            # write to a temporary file first so that an interrupted merge
+            # never leaves a truncated output behind
+            merge_shards(paths, chunks, prefix + suffix + ".tmp",
+                         nbest=args.nbest is not None)
+            os.rename(prefix + suffix + ".tmp", prefix + suffix)
+
+
+def read_manifest(path, key):
+    """Returns ids of completed chunks, or None if the manifest is missing or
+    was written for another input or configuration."""
+    if not os.path.exists(path):
+        return None
+    done = set()
+    with open(path) as manifest_io:
+        if manifest_io.readline().split() != ["key", key]:
+            return None
+        for line in manifest_io:
+            fields = line.split()
+            # skip a partially written last line
+            if len(fields) == 4 and fields[0] == "done":
+                done.add(int(fields[1]))
+    return done
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
+
+
+def run_deduplicated(args, prefix, lm, wc, use_sparse):
+    """Corrects only unique sentences of {prefix}.in and copies the results
+    back to all occurrences, keeping the original order of outputs,
+    alignments and n-best lists."""
+    with profile_stage("deduplicate", "{}.in".format(prefix),
+                       "{}.uniq.in".format(prefix)):
+        ids = {}
+        index = []
+        with open("{}.in".format(prefix)) as in_io, \
+                open("{}.uniq.in".format(prefix), 'w') as uniq_io:
+            for line in in_io:
+                line = line.rstrip("\r\n")
+                if line not in ids:
+                    ids[line] = len(ids)
+                    uniq_io.write(line + "\n")
+                index.append(ids[line])
+
+    print >> sys.stderr, "Deduplication: {} lines, {} unique ({:.1f}%" \
+        " duplicates not decoded)".format(
+            len(index), len(ids),
+            100.0 * (len(index) - len(ids)) / max(len(index), 1))
+
+    uniq_prefix = "{}.uniq".format(prefix)
+    # only fan out files written by this run, not those of an earlier run
+    # in the same workdir
+    for suffix in (".out", ".out.tok", ".out.tok.aln", ".out.tok.nbest"):
+        if os.path.exists(uniq_prefix + suffix):
+            os.remove(uniq_prefix + suffix)
+    if args.cache:
+        run_cached(args, uniq_prefix, lm, wc, use_sparse)
+    else:
+        correct_file(args, uniq_prefix, lm, wc, use_sparse)
+
+    with profile_stage("fan out", "{}.uniq.out".format(prefix),
+                       "{}.out".format(prefix)):
+        suffixes = [(".out", args.nbest is not None)]
+        if args.nbest is None:
+            suffixes += [(".out.tok", False), (".out.tok.aln", False)]
+        else:
+            suffixes.append((".out.tok.nbest", True))
+        for suffix, nbest in suffixes:
+            if os.path.exists(uniq_prefix + suffix):
+                fan_out(uniq_prefix + suffix, prefix + suffix, index, nbest)
+            elif os.path.exists(prefix + suffix):
+                os.remove(prefix + suffix)
+
+
+def fan_out(uniq_path, out_path, index, nbest=False):
+    """Writes the output of each unique sentence for every input line that
+    maps to it. N-best list ids are renumbered to input line ids."""
+    outputs = [[] for _ in range(max(index) + 1 if index else 0)]
+    with open(uniq_path) as uniq_io:
+        for j, line in enumerate(uniq_io):
+            if nbest:
+                idx, rest = line.split(" ||| ", 1)
+                outputs[int(idx)].append(rest)
+            else:
+                outputs[j].append(line)
+
+    with open(out_path, 'w') as out_io:
+        for i, j in enumerate(index):
+            for line in outputs[j]:
+                if nbest:
+                    out_io.write("{} ||| {}".format(i, line))
+                else:
+                    out_io.write(line)
+
+
+def run_cached(args, prefix, lm, wc, use_sparse):
+    """Corrects {prefix}.in using a persistent cache of corrected sentences.
+    Only sentences missing from the cache are passed to Moses, the rest is
+    taken from the cache. Alignment files are not produced in this mode."""
+    cache = SentenceCache(args.cache, config_hash(args, lm),
+                          args.cache_size)
+
+    with open("{}.in".format(prefix)) as in_io:
+        lines = [line.rstrip("\r\n") for line in in_io]
+    outputs = [cache.get(line) for line in lines]
+    misses = [i for i, output in enumerate(outputs) if output is None]
+
+    if misses:
+        miss_prefix = "{}.miss".format(prefix)
+        write_lines("{}.in".format(miss_prefix), [lines[i] for i in misses])
+        correct_file(args, miss_prefix, lm, wc, use_sparse)
+
+        with open("{}.out".format(miss_prefix)) as miss_io:
+            if args.nbest is None:
+                miss_outputs = [[line.rstrip("\n")] for line in miss_io]
+            else:
+                miss_outputs = [[] for _ in misses]
+                for line in miss_io:
+                    idx, rest = line.rstrip("\n").split(" ||| ", 1)
+                    miss_outputs[int(idx)].append(rest)
+        for i, output in zip(misses, miss_outputs):
+            outputs[i] = output
+            cache.put(lines[i], output)
+
+    with open("{}.out".format(prefix), 'w') as out_io:
+        for i, output in enumerate(outputs):
+            for line in output:
+                if args.nbest is None:
+                    out_io.write(line + "\n")
+                else:
+                    out_io.write("{} ||| {}\n".format(i, line))
+
+    cache.close()
+    print >> sys.stderr, "Cache: {} hits, {} misses ({:.1f}% hit rate)" \
+        .format(len(lines) - len(misses), len(misses),
+                100.0 * (len(lines) - len(misses)) / max(len(lines), 1))
+
+
+def config_hash(args, lm):
+    """Hashes the Moses configuration, including sparse feature weights,
+    together with the options that change the output: the n-best size, the
+    tokenizer, the truecaser and its LM, and the postprocessor."""
+    sha = hashlib.sha1()
+    with open(args.config) as config_io:
+        ini = config_io.read()
+    sha.update(ini)
+    match = re.search(r'^\[weight-file\]\s*\n(\S+)', ini, re.MULTILINE)
+    if match and os.path.exists(match.group(1)):
+        with open(match.group(1)) as weights_io:
+            sha.update(weights_io.read())
+    sha.update("nbest={}".format(args.nbest))
+    sha.update("tokenizer={}".format(args.tokenizer))
+    sha.update("truecaser={} lm={}".format(args.truecaser, lm))
+    sha.update("postprocessor={}".format(args.postprocessor))
+    return sha.hexdigest()
+
+
+class SentenceCache(object):
+    """Persistent cache mapping input sentences to corrected outputs, bounded
+    to the given number of entries by evicting least recently used ones."""
+
+    def __init__(self, path, config_key, size):
+        self.config_key = config_key
+        self.size = size
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.db.execute("CREATE TABLE IF NOT EXISTS cache"
+                        " (key TEXT PRIMARY KEY, output TEXT, used INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS cache_used"
+                        " ON cache (used)")
+        self.clock = self.db.execute(
+            "SELECT COALESCE(MAX(used), 0) FROM cache").fetchone()[0]
+
+    def key(self, sentence):
+        return hashlib.sha1(self.config_key + "\t" + sentence).hexdigest()
+
+    def get(self, sentence):
+        key = self.key(sentence)
+        row = self.db.execute("SELECT output FROM cache WHERE key = ?",
+                              (key, )).fetchone()
+        if row is None:
+            return None
+        self.clock += 1
+        self.db.execute("UPDATE cache SET used = ? WHERE key = ?",
+                        (self.clock, key))
+        return row[0].split("\n")
+
+    def put(self, sentence, output):
+        self.clock += 1
+        self.db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                        (self.key(sentence), "\n".join(output), self.clock))
+
+    def close(self):
+        count = self.db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if count > self.size:
+            self.db.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache"
+                " ORDER BY used LIMIT ?)", (count - self.size, ))
+        self.db.commit()
+        self.db.close()
+
+
+def run_sharded(args, prefix, lm, wc, use_sparse):
+    """Splits {prefix}.in into length-balanced shards, corrects them with
+    parallel pipelines and merges outputs, alignments and n-best lists back
+    in the original order."""
+    with open("{}.in".format(prefix)) as in_io:
+        lines = in_io.readlines()
+    shards = [idxs for idxs in balance_shards(lines, args.shards) if idxs]
+
+    shard_args = copy.copy(args)
+    shard_args.shards = 1
+    shard_args.threads = max(1, args.threads // len(shards))
+
+    prefixes = []
+    for k, idxs in enumerate(shards):
+        shard_prefix = "{}.shard{}".format(prefix, k)
+        with open("{}.in".format(shard_prefix), 'w') as shard_io:
+            for i in idxs:
+                shard_io.write(lines[i])
+        prefixes.append(shard_prefix)
+
+    times = [None] * len(shards)
+
+    def correct_shard(k):
+        start = time.time()
+        try:
+            correct_file(shard_args, prefixes[k], lm, wc, use_sparse)
+        except SystemExit:
+            # the other shards are useless now, stop them
+            abort_pipelines()
+            return
+        except Exception:
+            abort_pipelines()
+            raise
+        times[k] = time.time() - start
+
+    threads = [threading.Thread(target=correct_shard, args=(k, ),
+                                name="shard{}".format(k))
+               for k in range(len(shards))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for k, idxs in enumerate(shards):
+        if times[k] is None:
+            print >> sys.stderr, "Shard {} failed".format(k)
+            exit(1)
+        words = sum(len(lines[i].split()) for i in idxs)
+        print >> sys.stderr, \
+            "Shard {}: {} sentences, {} words, {:.1f}s, {:.2f} sents/s" \
+            .format(k, len(idxs), words, times[k],
+                    len(idxs) / max(times[k], 1e-6))
+    print >> sys.stderr, "Slowest shard: {}".format(
+        max(range(len(shards)), key=lambda k: times[k]))
+
+    suffixes = [".out"]
+    if args.nbest is None:
+        suffixes.append(".out.tok.aln")
+    else:
+        suffixes.append(".out.tok.nbest")
+    for suffix in suffixes:
+        paths = [p + suffix for p in prefixes]
+        if all(os.path.exists(p) for p in paths):
+            merge_shards(paths, shards, prefix + suffix,
+                         nbest=args.nbest is not None)
+
+
+def balance_shards(lines, num_shards):
+    """Assigns lines to shards so that all shards have a similar number of
+    words. Returns a sorted list of line indices for each shard."""
+    heap = [(0, k) for k in range(num_shards)]
+    shards = [[] for _ in range(num_shards)]
+    by_length = sorted(range(len(lines)), key=lambda i: -len(lines[i].split()))
+    for i in by_length:
+        load, k = heapq.heappop(heap)
+        shards[k].append(i)
+        heapq.heappush(heap, (load + len(lines[i].split()) + 1, k))
+    return [sorted(idxs) for idxs in shards]
+
+
+def merge_shards(paths, shards, out_path, nbest=False):
+    """Merges shard files back in the original order. N-best list ids are
+    renumbered from shard-local to global sentence ids."""
+
+    def each_line(path, idxs):
+        with open(path) as shard_io:
+            for j, line in enumerate(shard_io):
+                if nbest:
+                    idx, rest = line.split(" ||| ", 1)
+                    yield idxs[int(idx)], "{} ||| {}".format(
+                        idxs[int(idx)], rest)
+                else:
+                    yield idxs[j], line
+
+    with open(out_path, 'w') as out_io:
+        for _, line in heapq.merge(*[each_line(path, idxs)
+                                     for path, idxs in zip(paths, shards)]):
+            out_io.write(line)
+
+
+def preprocess_cmd(args, lm, truecase=True, tokenize=True):
+    """Shell pipeline that detokenizes, tokenizes and truecases raw text."""
+    return " | ".join(cmd for _, cmd
+                      in preprocess_stages(args, lm, truecase, tokenize))
+
+
+def preprocess_stages(args, lm, truecase=True, tokenize=True):
+    stages = []
+    if tokenize:
+        stages.append(("detokenize",
+                       "{}/m2_tok/detokenize.py".format(args.scripts)))
+        stages.append(("tokenize", tokenize_cmd(args)))
+    if truecase:
+        stages.append(("truecase", truecase_cmd(args, lm)))
+    return stages
+
+
+def tokenize_cmd(args):
+    if args.tokenizer == "python":
+        return "python {}/m2_tok/moses_tokenizer.py -threads {} -moses {}" \
+            .format(args.scripts, args.threads, args.moses)
+    return "{}/scripts/tokenizer/tokenizer.perl -threads {}" \
+        .format(args.moses, args.threads)
+
+
+def truecase_cmd(args, lm):
+    if args.truecaser == "kenlm":
+        return "python {}/case_graph.py --lm {} --threads {}" \
+            .format(args.scripts, lm, args.threads)
+    return "{}/case_graph.perl --lm {} --decode {}/bin/decode" \
+        .format(args.scripts, lm, args.lazy)
+
+
+def postprocess_cmd(args, orig_in, aln_in):
+    """Shell pipeline that restores casing and tokenization of the output."""
+    return " | ".join(cmd for _, cmd in postprocess_stages(args, orig_in, aln_in))
+
+
+def postprocess_stages(args, orig_in, aln_in):
+    if args.postprocessor == "python":
+        return [("postprocess", "python {}/impose.py -j {} {} {}"
+                 .format(args.scripts, args.threads, orig_in, aln_in))]
+    return [
+        ("impose case", "{}/impose_case.perl {} {}"
+         .format(args.scripts, orig_in, aln_in)),
+        ("deescape", "{}/scripts/tokenizer/deescape-special-chars.perl"
+         .format(args.moses)),
+        ("impose tok", "{}/impose_tok.perl {}".format(args.scripts, orig_in)),
+    ]
+
+
+def word_classes_cmd(args, wc):
+    return "perl {}/anottext.pl -f {}".format(args.scripts, wc)
+
+
+def nbest_options(args):
+    return "-n-best-list - {} distinct -print-alignment-info-in-n-best" \
+           " -labeled-n-best-list false".format(args.nbest)
+
+
+def moses_cmd(args, options=""):
+    return "{moses}/bin/moses -f {ini} {opts} -threads {th} -fd '|'" \
+        .format(moses=args.moses, ini=args.config, opts=options,
+                th=args.threads)
+
+
+def run_filter(cmd, lines):
+    """Pipes lines through a shell command and returns the output lines."""
+    proc = subprocess.Popen(cmd, shell=True,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output, _ = proc.communicate("".join(l + "\n" for l in lines))
+    if proc.returncode != 0:
+        raise RuntimeError("Command failed with exit code {}: {}"
+                           .format(proc.returncode, cmd))
+    return output.rstrip("\n").split("\n") if lines else []
+
+
+def load_word_classes(wc_path):
+    """Loads word classes the same way anottext.pl does."""
+    classes = {}
+    open_fn = gzip.open if wc_path.endswith(".gz") else open
+    with open_fn(wc_path) as wc_io:
+        for line in wc_io:
+            fields = line.split()
+            if len(fields) >= 2:
+                classes[fields[0]] = fields[1]
+    return classes
+
+
+def annotate_word_classes(line, classes):
+    """Factors each token with its word class, like `anottext.pl -f`."""
+    return " ".join("{}|{}".format(t, classes.get(t.split("|")[0], "G"))
+                    for t in line.split())
+
+
+class GECServer(object):
+    """Keeps a single Moses process alive and corrects batches of raw
+    sentences with it.
+
+    Requests are served one at a time; other requests wait in a queue and
+    the queue depth and per-request latency are reported on stderr.
+    """
+
+    def __init__(self, args, lm, wc, use_sparse):
+        self.args = args
+        self.truecaser = None
+        if args.truecaser == "kenlm":
+            # keep the truecasing LM loaded as well
+            from case_graph import Truecaser
+            print >> sys.stderr, "Loading truecaser LM:", lm
+            self.truecaser = Truecaser(lm)
+        self.tokenizer = None
+        if args.tokenizer == "python":
+            # detokenize and tokenize in-process
+            from detokenize import detokenize_nltk
+            from moses_tokenizer import MosesTokenizer
+            self.detokenize = detokenize_nltk
+            self.tokenizer = MosesTokenizer(moses=args.moses)
+        self.prep = preprocess_cmd(args, lm, truecase=self.truecaser is None,
+                                   tokenize=self.tokenizer is None)
+        self.impose = None
+        if args.postprocessor == "python":
+            from impose import impose
+            self.impose = impose
+        self.classes = None
+        if use_sparse:
+            print >> sys.stderr, "Loading word classes:", wc
+            self.classes = load_word_classes(wc)
+
+        cmd = moses_cmd(args, "-print-alignment-info")
+        print >> sys.stderr, "Run:", cmd
+        self.moses = subprocess.Popen(cmd, shell=True, bufsize=1,
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE)
+
+        self.lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.queued = 0
+        self.requests = 0
+        self.sentences = 0
+        self.total_time = 0.0
+
+    def correct(self, sentences):
+        """Runs the full correction chain for a batch of raw sentences."""
+        with self.stats_lock:
+            self.queued += 1
+            depth = self.queued
+        start = time.time()
+        with self.lock:
+            with self.stats_lock:
+                self.queued -= 1
+            output = self._correct(sentences)
+        elapsed = time.time() - start
+
+        with self.stats_lock:
+            self.requests += 1
+            self.sentences += len(sentences)
+            self.total_time += elapsed
+            print >> sys.stderr, \
+                "Request {}: {} sentences, {:.3f}s, queue depth {}," \
+                " avg latency {:.3f}s".format(
+                    self.requests, len(sentences), elapsed, depth - 1,
+                    self.total_time / self.requests)
+        return output
+
+    def _correct(self, sentences):
+        if not sentences:
+            return []
+        sentences = [s.strip() for s in sentences]
+        toks = sentences
+        if self.tokenizer is not None:
+            toks = [self.tokenizer.tokenize(self.detokenize(s)) for s in toks]
+        if self.prep:
+            toks = run_filter(self.prep, toks)
+        if self.truecaser is not None:
+            toks = [self.truecaser.truecase(t) for t in toks]
+        if self.classes is not None:
+            toks = [annotate_word_classes(t, self.classes) for t in toks]
+
+        texts, alns = self._decode(toks)
+        if self.impose is not None:
+            return [self.impose(text, sent, aln)
+                    for text, sent, aln in zip(texts, sentences, alns)]
+
+        tmpdir = tempfile.mkdtemp(prefix="server.", dir=self.args.workdir)
+        try:
+            orig_in = os.path.join(tmpdir, "in")
+            aln_in = os.path.join(tmpdir, "out.tok.aln")
+            write_lines(orig_in, sentences)
+            write_lines(aln_in, alns)
+            return run_filter(postprocess_cmd(self.args, orig_in, aln_in),
+                              texts)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def _decode(self, toks):
+        # write from a separate thread so that large batches do not
+        # deadlock on full pipe buffers
+        def feed():
+            for tok in toks:
+                self.moses.stdin.write(tok + "\n")
+            self.moses.stdin.flush()
+
+        writer = threading.Thread(target=feed)
+        writer.start()
+        texts, alns = [], []
+        for _ in toks:
+            line = self.moses.stdout.readline()
+            if not line:
+                raise RuntimeError("Moses process terminated unexpectedly")
+            text, _, aln = line.rstrip("\n").partition(" ||| ")
+            texts.append(text.strip())
+            alns.append(aln.strip())
+        writer.join()
+        return texts, alns
+
+    def close(self):
+        self.moses.stdin.close()
+        self.moses.wait()
+
+
+class GECRequestHandler(SocketServer.StreamRequestHandler):
+    """Reads batches of sentences terminated by an empty line and answers
+    with the corrected sentences terminated by an empty line."""
+
+    def handle(self):
+        for batch in read_batches(self.rfile):
+            try:
+                output = self.server.gec.correct(batch)
+            except Exception as exc:
+                print >> sys.stderr, "Error:", exc
+                return
+            write_batch(self.wfile, output)
+
+
+class GECTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def run_server(args, lm, wc, use_sparse):
+    gec = GECServer(args, lm, wc, use_sparse)
+    try:
+        if args.port:
+            server = GECTCPServer((args.host, args.port), GECRequestHandler)
+            server.gec = gec
+            print >> sys.stderr, "Listening on {}:{}".format(
+                args.host, args.port)
+            server.serve_forever()
+        else:
+            print >> sys.stderr, "Reading batches from stdin"
+            for batch in read_batches(sys.stdin):
+                write_batch(sys.stdout, gec.correct(batch))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gec.close()
+
+
+def read_batches(io):
+    """Yields batches of lines separated by empty lines."""
+    batch = []
+    for line in iter(io.readline, ""):
+        line = line.rstrip("\r\n")
+        if line:
+            batch.append(line)
+        else:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_batch(io, lines):
+    for line in lines:
+        io.write(line + "\n")
+    io.write("\n")
+    io.flush()
+
+
+def write_lines(path, lines):
+    with open(path, 'w') as io:
+        for line in lines:
+            io.write(line + "\n")
+
+
+def impose_nbest(nbest_io, orig_io, out_io, threads=1):
+    """Restores casing and tokenization of a Moses n-best list read from a
+    stream, and writes it as `id ||| text ||| score`. Original sentences are
+    looked up by id and each distinct hypothesis is post-processed once, so
+    only one sentence's n-best list is kept in memory at a time."""
+    groups = each_nbest_group(nbest_io, orig_io)
+    if threads > 1:
+        pool = multiprocessing.Pool(threads)
+        results = pool.imap(impose_nbest_group, groups, chunksize=16)
+    else:
+        pool = None
+        results = itertools.imap(impose_nbest_group, groups)
+
+    for lines in results:
+        out_io.write("".join(lines))
+
+    if pool:
+        pool.close()
+        pool.join()
+
+
+def each_nbest_group(nbest_io, orig_io):
+    """Yields (id, original sentence, hypotheses) for each sentence of an
+    n-best list, where hypotheses are (text, score, alignment) tuples."""
+    orig_idx = -1
+    orig = None
+    last_idx = None
+    hyps = []
+    for line in iter(nbest_io.readline, ""):
+        idx, sent, _, score, align = [f.strip() for f in line.split(" ||| ")]
+        idx = int(idx)
+        if idx != last_idx:
+            if hyps:
+                yield last_idx, orig, hyps
+            hyps = []
+            last_idx = idx
+            while orig_idx < idx:
+                orig = orig_io.readline().rstrip("\n")
+                orig_idx += 1
+        hyps.append((sent, score, align))
+    if hyps:
+        yield last_idx, orig, hyps
+
+
+def impose_nbest_group(group):
+    from impose import impose
+    idx, orig, hyps = group
+    done = {}
+    lines = []
+    for sent, score, align in hyps:
+        if (sent, align) not in done:
+            done[sent, align] = impose(sent, orig, align)
+        lines.append("{} ||| {} ||| {}\n".format(idx, done[sent, align],
+                                                  score))
+    return lines
 
 
 def reconstruct_nbest_list(nbest_in, txt_in, nbest_out):
@@ -136,8 +1259,7 @@ def extract_text_and_alignment(nbest_file, orig_in, txt_out, aln_out,
 
 
 def run_cmd(cmd):
-    print >> sys.stderr, "Run:", cmd
-    os.popen(cmd)
+    run_stages([(None, cmd)])
 
 
 def parse_config_ini(config):
@@ -147,29 +1269,29 @@ def parse_config_ini(config):
 
     if "name=LM1" in ini:
         lmpath = re.search(r'name=LM1 .*path=(.*) order=', ini).group(1)
-        print "Found LM: {}".format(lmpath)
+        print >> sys.stderr, "Found LM: {}".format(lmpath)
     if "name=Generation0" in ini:
         wcpath = re.search(r'Generation name=Generation0 .* path=(.*)',
                            ini).group(1)
-        print "Found WC: {}".format(wcpath)
+        print >> sys.stderr, "Found WC: {}".format(wcpath)
 
     if not lmpath:
-        print "No LM found!"
+        print >> sys.stderr, "No LM found!"
         exit(1)
     if not wcpath:
-        print "No WC found!"
+        print >> sys.stderr, "No WC found!"
         exit(1)
 
     sparse = "[weight-file]" in ini
     if sparse:
-        print "Found sparse features"
+        print >> sys.stderr, "Found sparse features"
     return lmpath, wcpath, sparse
 
 
 def parse_user_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("-f", "--config", help="Moses INI file", required=True)
-    parser.add_argument("-i", "--input", help="Input file", required=True)
+    parser.add_argument("-i", "--input", help="Input file")
     parser.add_argument("-o", "--output", help="Output file")
     parser.add_argument(
         "-w", "--workdir", help="Working directory", default=".")
@@ -182,10 +1304,81 @@ def parse_user_args():
         "--scripts",
         help="Path to baselines-emnlp2016/train/scripts",
         default=SCRIPTS)
+    parser.add_argument(
+        "--truecaser",
+        help="Truecase with case_graph.perl and lazy, or in-process with"
+        " case_graph.py and KenLM (default: lazy, kenlm in server mode)",
+        choices=["lazy", "kenlm"])
+    parser.add_argument(
+        "--tokenizer",
+        help="Tokenize with tokenizer.perl, or with moses_tokenizer.py,"
+        " in-process in server mode",
+        choices=["perl", "python"],
+        default="perl")
+    parser.add_argument(
+        "--postprocessor",
+        help="Restore casing and tokenization with impose_case.perl,"
+        " deescape-special-chars.perl and impose_tok.perl, or with impose.py"
+        " in a single pass",
+        choices=["perl", "python"],
+        default="perl")
     parser.add_argument(
         "-t", "--threads", help="Number of threads", type=int, default=THREADS)
     parser.add_argument("--nbest", help="Generate n-best list", type=int)
-    return parser.parse_args()
+
+    parser.add_argument(
+        "--cache", help="Path to a persistent cache of corrected sentences")
+    parser.add_argument(
+        "--cache-size",
+        help="Maximum number of sentences kept in the cache",
+        type=int,
+        default=1000000)
+    parser.add_argument(
+        "--shards",
+        help="Split input into this many shards decoded in parallel",
+        type=int,
+        default=1)
+    parser.add_argument(
+        "--stream",
+        help="Connect all stages with pipes instead of intermediate files",
+        action="store_true")
+    parser.add_argument(
+        "--chunk-size",
+        help="Correct input in chunks of this many sentences and resume"
+        " from the last completed chunk when restarted",
+        type=int)
+    parser.add_argument(
+        "--dedup",
+        help="Correct each distinct input sentence only once",
+        action="store_true")
+    parser.add_argument(
+        "--profile",
+        help="Write time, CPU, memory and throughput of each stage to"
+        " {workdir}/{input}.profile.json",
+        action="store_true")
+    parser.add_argument(
+        "--profile-summary",
+        help="Also print the profile as a table on stderr",
+        action="store_true")
+    parser.add_argument(
+        "--server",
+        help="Keep the model loaded and correct batches of sentences"
+        " separated by empty lines, read from stdin or a socket",
+        action="store_true")
+    parser.add_argument(
+        "--port", help="Listen on this TCP port in server mode", type=int)
+    parser.add_argument(
+        "--host", help="Host to bind in server mode", default="localhost")
+    args = parser.parse_args()
+    if args.profile_summary:
+        args.profile = True
+    if not args.input and not args.server:
+        parser.error("argument -i/--input is required")
+    if args.server and args.nbest is not None:
+        parser.error("argument --nbest is not supported in server mode")
+    if args.truecaser is None:
+        args.truecaser = "kenlm" if args.server else "lazy"
+    return args
 
 
 if __name__ == '__main__':
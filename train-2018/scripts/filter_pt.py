@@ -0,0 +1,192 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+"""
+Filters a phrase table to phrases whose source side occurs as a 1-7-gram in
+the given filter files. This is a replacement for filter_pt.perl: n-grams are
+stored as 64-bit hash fingerprints in a sorted array instead of a hash of
+strings, and the phrase table is streamed through a pool of worker processes.
+
+Fingerprint hits are not confirmed against the n-gram strings, so the output
+equals that of filter_pt.perl only with high probability. A phrase that does
+not occur in the filter files is kept if its fingerprint collides with one of
+the N stored n-grams, with probability about N / 2^64 per phrase, e.g. about
+0.5 expected extra lines for 10^7 n-grams and 10^12 phrases. Lines that
+filter_pt.perl keeps are never dropped.
+
+usage: zcat phrase-table.gz | ./filter_pt.py [-j 16] test.txt > filtered
+       ./filter_pt.py -j 16 -i phrase-table.gz -o filtered.gz test.txt
+"""
+
+import io
+import re
+import sys
+import gzip
+import time
+import zlib
+import array
+import heapq
+import argparse
+import resource
+import collections
+import multiprocessing
+
+from bisect import bisect_left
+
+THREADS = 1
+MAX_LENGTH = 7
+
+# size of a block of lines sent to a worker process
+CHUNK_BYTES = 4 * 1024 * 1024
+# number of fingerprints sorted at once while reading filter files
+RUN_SIZE = 1000000
+
+RE_SEPARATOR = re.compile(r'\s\|\|\|\s')
+
+fingerprints = None
+compress = False
+
+
+def main():
+    global fingerprints
+    global compress
+    args = parse_args()
+
+    start = time.time()
+    fingerprints = read_filters(args.filters)
+    print >> sys.stderr, "Stored {} n-grams in {:.1f}s ({:.1f} MB)".format(
+        len(fingerprints), time.time() - start,
+        len(fingerprints) * fingerprints.itemsize / 1024.0 / 1024.0)
+
+    in_io = open_input(args.input)
+    out_io = open(args.output, 'wb') if args.output else sys.stdout
+    compress = bool(args.output) and args.output.endswith('.gz')
+
+    start = time.time()
+    kept = total = 0
+    if args.jobs > 1:
+        chunks = process_parallel(each_chunk(in_io), args.jobs)
+    else:
+        chunks = (filter_chunk(chunk) for chunk in each_chunk(in_io))
+    for chunk_kept, chunk_total, text in chunks:
+        out_io.write(text)
+        kept += chunk_kept
+        total += chunk_total
+
+    if out_io is not sys.stdout:
+        out_io.close()
+
+    elapsed = time.time() - start
+    print >> sys.stderr, "{}/{}".format(kept, total)
+    print >> sys.stderr, "Kept {:.1f}% of phrases, {:.1f}s ({:.1f} lines/s)," \
+        " peak memory {:.1f} MB".format(
+            100.0 * kept / max(total, 1), elapsed, total / max(elapsed, 1e-6),
+            peak_memory() / 1024.0)
+
+
+def read_filters(paths):
+    """Returns a sorted array of fingerprints of all n-grams up to
+    MAX_LENGTH tokens in the given files."""
+    runs = []
+    run = set()
+    for path in paths:
+        with open(path) as filter_io:
+            for line in filter_io:
+                tokens = line.split()
+                for start in xrange(len(tokens)):
+                    for end in xrange(start + 1,
+                                      min(start + MAX_LENGTH, len(tokens)) + 1):
+                        run.add(hash(' '.join(tokens[start:end])))
+                if len(run) >= RUN_SIZE:
+                    runs.append(array.array('l', sorted(run)))
+                    run = set()
+        print >> sys.stderr, "Read filter"
+    runs.append(array.array('l', sorted(run)))
+    del run
+
+    if len(runs) == 1:
+        return runs[0]
+    merged = array.array('l')
+    last = None
+    for fingerprint in heapq.merge(*runs):
+        if fingerprint != last:
+            merged.append(fingerprint)
+            last = fingerprint
+    return merged
+
+
+def contains(fingerprint):
+    i = bisect_left(fingerprints, fingerprint)
+    return i < len(fingerprints) and fingerprints[i] == fingerprint
+
+
+def filter_chunk(lines):
+    kept = [line for line in lines
+            if contains(hash(RE_SEPARATOR.split(line, 1)[0]))]
+    text = ''.join(kept)
+    if compress:
+        # chunks are compressed by workers as separate gzip members, which
+        # concatenated form a valid gzip file
+        gz = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        text = gz.compress(text) + gz.flush()
+    return len(kept), len(lines), text
+
+
+def each_chunk(in_io):
+    while True:
+        lines = in_io.readlines(CHUNK_BYTES)
+        if not lines:
+            break
+        yield lines
+
+
+def process_parallel(chunks, jobs):
+    """Filters chunks in forked workers, which share the fingerprints, and
+    yields results in the input order. Only a few chunks are read ahead to
+    keep memory bounded."""
+    pool = multiprocessing.Pool(jobs)
+    pending = collections.deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(filter_chunk, (chunk, )))
+        if len(pending) >= 2 * jobs:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+    pool.close()
+    pool.join()
+
+
+def open_input(path):
+    if path is None:
+        return sys.stdin
+    with open(path, 'rb') as magic_io:
+        is_gzip = magic_io.read(2) == '\x1f\x8b'
+    if is_gzip:
+        return io.BufferedReader(gzip.open(path), CHUNK_BYTES)
+    return open(path)
+
+
+def peak_memory():
+    """Peak resident memory in kB of this process and its workers."""
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Filters phrase table by n-grams of the given files.")
+    parser.add_argument("filters", nargs='+', help="filter files")
+    parser.add_argument(
+        "-i", "--input", help="phrase table, plain or gzipped, default: stdin")
+    parser.add_argument(
+        "-o", "--output",
+        help="output file, gzipped if it ends with .gz, default: stdout")
+    parser.add_argument(
+        "-j", "--jobs",
+        help="number of parallel jobs, default: 1",
+        type=int,
+        default=THREADS)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
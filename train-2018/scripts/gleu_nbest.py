@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+Extracts GLEU sufficient statistics of all hypotheses in a Moses n-best list,
+in the score and feature file formats written by the extractor of Moses mert.
+
+The n-best list is in the format of moses -n-best-list or run_gecsmt.py
+--nbest, i.e. 'id ||| text ||| features ||| score' or 'id ||| text ||| score',
+where ids are line numbers of --srcrefs counted from 0. A hypothesis gets the
+statistics (c, r, num_1, den_1, ... num_n, den_n) of gleu_srcrefs.GLEU against
+each reference in turn, so with k references there are k * (2n + 2) of them.
+Features can only be extracted from n-best lists with a labeled features field
+(moses -labeled-n-best-list true, the default).
+
+usage: ./gleu_nbest.py --srcrefs dev.txt --nbest run1.best100.out \\
+           --scfile run1.scores.dat --ffile run1.features.dat -j 8
+"""
+
+import sys
+import argparse
+import itertools
+import multiprocessing
+
+from gleu_srcrefs import GLEU
+
+SCORER_NAME = 'GLEU'
+CHUNK_SIZE = 20
+
+
+def read_nbest(nbest_io):
+    """Yields (id, hypotheses) for each sentence of an n-best list, where
+    hypotheses are (text, features) tuples and features is None if the list
+    has no features field."""
+    def parse(line):
+        fields = line.rstrip('\n').split(' ||| ')
+        features = fields[2] if len(fields) > 3 else None
+        return int(fields[0]), fields[1].strip(), features
+
+    entries = itertools.imap(parse, nbest_io)
+    for idx, group in itertools.groupby(entries, key=lambda entry: entry[0]):
+        yield idx, [(text, features) for _, text, features in group]
+
+
+def nbest_stats(gleu_calculator, idx, texts):
+    """GLEU statistics of hypotheses of the idx-th sentence against each of
+    its references, as a list for each hypothesis."""
+    stats = gleu_calculator.hypotheses_stats(
+        idx, [text.split() for text in texts])
+    return stats.reshape(len(texts), -1).tolist()
+
+
+def feature_names(features):
+    """Names of dense features as Moses mert gives them, e.g. LM0_0. Sparse
+    features, whose names contain '_', are left out."""
+    names = []
+    name = None
+    tokens = iter(features.split())
+    for token in tokens:
+        if not token.endswith('='):
+            if name is None:
+                raise ValueError("N-best list has unlabeled features, "
+                                 "use moses -labeled-n-best-list true")
+            names.append('%s_%i' % (name, index))
+            index += 1
+        elif '_' in token:
+            next(tokens, None)
+        else:
+            name, index = token[:-1], 0
+    return names
+
+
+def feature_values(features):
+    """Dense feature values followed by names and values of sparse features,
+    as in lines of a Moses mert feature file."""
+    dense = []
+    sparse = []
+    tokens = iter(features.split())
+    for token in tokens:
+        if not token.endswith('='):
+            dense.append('%g' % float(token))
+        elif '_' in token:
+            value = float(next(tokens))
+            if value != 0:
+                sparse.append('%s %g' % (token, value))
+    return ' '.join(dense + sparse)
+
+
+def score_block(idx, stats):
+    lines = ['SCORES_TXT_BEGIN_0 %i %i %i %s\n'
+             % (idx, len(stats), len(stats[0]), SCORER_NAME)]
+    lines.extend(' '.join(str(s) for s in row) + ' \n' for row in stats)
+    lines.append('SCORES_TXT_END_0\n')
+    return ''.join(lines)
+
+
+def feature_block(idx, features, names):
+    lines = ['FEATURES_TXT_BEGIN_0 %i %i %i %s \n'
+             % (idx, len(features), len(names), ' '.join(names))]
+    lines.extend(feature_values(f) + ' \n' for f in features)
+    lines.append('FEATURES_TXT_END_0\n')
+    return ''.join(lines)
+
+
+_gleu_calculator = None
+_feature_names = None
+
+
+def extract_chunk(groups):
+    """Score and feature blocks of a chunk of n-best sentences."""
+    blocks = []
+    for idx, hyps in groups:
+        stats = nbest_stats(_gleu_calculator, idx, [text for text, _ in hyps])
+        features = None
+        if _feature_names is not None:
+            features = feature_block(idx, [f for _, f in hyps],
+                                     _feature_names)
+        blocks.append((score_block(idx, stats), features))
+    return blocks
+
+
+def extract(gleu_calculator, nbest_io, with_features=True, jobs=1,
+            chunk_size=CHUNK_SIZE):
+    """Yields (score block, feature block) for each sentence of an n-best
+    list, in the order of the list. Sentences are processed in chunks in
+    forked worker processes if jobs > 1, which share the reference tables
+    of gleu_calculator. The feature block is None unless with_features."""
+    global _gleu_calculator, _feature_names
+    groups = read_nbest(nbest_io)
+    first = next(groups, None)
+    if first is None:
+        return
+    groups = itertools.chain([first], groups)
+
+    _gleu_calculator = gleu_calculator
+    _feature_names = None
+    if with_features:
+        features = first[1][0][1]
+        if features is None:
+            raise ValueError("N-best list has no features field")
+        _feature_names = feature_names(features)
+
+    chunks = iter(lambda: list(itertools.islice(groups, chunk_size)), [])
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(extract_chunk, chunks)
+    else:
+        pool = None
+        results = itertools.imap(extract_chunk, chunks)
+
+    for blocks in results:
+        for block in blocks:
+            yield block
+
+    if pool:
+        pool.close()
+        pool.join()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Extracts GLEU statistics of a Moses n-best list.")
+    parser.add_argument(
+        "--srcrefs", required=True,
+        help="file with tab-separated src and ref(s)")
+    parser.add_argument(
+        "--index",
+        help="file with prepared n-gram tables of srcrefs, created if"
+             " missing or outdated")
+    parser.add_argument(
+        "--nbest", help="n-best list, default: stdin")
+    parser.add_argument(
+        "--scfile", help="output score file, default: stdout")
+    parser.add_argument("--ffile", help="output feature file")
+    parser.add_argument(
+        "-n", help="n-gram order", type=int, default=4)
+    parser.add_argument(
+        "-j", "--jobs", help="number of worker processes", type=int,
+        default=1)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    gleu_calculator = GLEU(args.n)
+    gleu_calculator.load_srcrefs(args.srcrefs, args.index)
+
+    nbest_io = open(args.nbest) if args.nbest else sys.stdin
+    score_io = open(args.scfile, 'w') if args.scfile else sys.stdout
+    feature_io = open(args.ffile, 'w') if args.ffile else None
+
+    for scores, features in extract(gleu_calculator, nbest_io,
+                                    feature_io is not None, args.jobs):
+        score_io.write(scores)
+        if feature_io:
+            feature_io.write(features)
+
+    for out_io in (score_io, feature_io):
+        if out_io not in (None, sys.stdout):
+            out_io.close()
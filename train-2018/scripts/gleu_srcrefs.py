@@ -16,14 +16,23 @@ __author__ = 'Courtney Napoles'
 __email__ = 'napoles@cs.jhu.edu'
 __date__ = '2016-11-04'
 
+import os
 import math
+import array
+import cPickle
 import numpy as np
 import scipy.stats
 import sys
+import time
 import random
 import argparse
+import multiprocessing
+from itertools import izip
 from collections import Counter
 
+INDEX_HEADER = 'GLEUINDEX {size} {mtime!r} {order}\n'
+CHUNK_SIZE = 100
+
 
 class GLEU:
 
@@ -33,7 +42,7 @@ class GLEU:
     def load_hypothesis_sentence(self, hypothesis):
         """load ngrams for a single sentence"""
         self.hlen = len(hypothesis)
-        self.this_h_ngrams = [self.get_ngram_counts(hypothesis, n)
+        self.this_h_ngrams = [self.get_ngram_id_counts(hypothesis, n)
                               for n in range(1, self.order + 1)]
 
     def load_sources(self, spath):
@@ -75,6 +84,94 @@ class GLEU:
                         if new_ngrams[nn] > ngrams.get(nn, 0):
                             ngrams[nn] = new_ngrams[nn]
 
+        self.build_ref_tables()
+
+    def build_ref_tables(self):
+        """precompute, for each sentence, reference and n-gram order, the
+        reference n-gram counts and the source n-grams not in the reference,
+        which are all gleu_stats() needs. N-grams are interned as integer
+        ids and the tables are kept as (ids, counts) arrays."""
+        self.ngram_ids = {}
+        self.ref_tables = []
+        for s_ngrams, refset in izip(self.all_s_ngrams, self.refs):
+            tables = []
+            self.ref_tables.append(tables)
+            for ref in refset:
+                orders = []
+                tables.append(orders)
+                for n in range(1, self.order + 1):
+                    r_ngrams = self.get_ngram_counts(ref, n)
+                    s_ngram_diff = self.get_ngram_diff(s_ngrams[n - 1],
+                                                       r_ngrams)
+                    orders.append(self.intern_ngrams(r_ngrams)
+                                  + self.intern_ngrams(s_ngram_diff))
+
+    def intern_ngrams(self, ngrams):
+        """returns arrays of ids and counts of n-grams"""
+        ids = array.array('i')
+        counts = array.array('i')
+        for ngram, count in ngrams.iteritems():
+            ids.append(self.ngram_ids.setdefault(ngram, len(self.ngram_ids)))
+            counts.append(count)
+        return ids, counts
+
+    def save_index(self, srcrefs, ipath):
+        """save the reference tables prepared for srcrefs"""
+        with open(ipath, 'wb') as index:
+            index.write(self.index_header(srcrefs))
+            cPickle.dump((self.num_refs, self.rlens, self.ngram_ids,
+                          self.ref_tables), index, cPickle.HIGHEST_PROTOCOL)
+
+    def load_index(self, srcrefs, ipath):
+        """load reference tables saved by save_index(), return False if the
+        index is missing or older than srcrefs"""
+        try:
+            with open(ipath, 'rb') as index:
+                if index.readline() != self.index_header(srcrefs):
+                    return False
+                (self.num_refs, self.rlens, self.ngram_ids,
+                 self.ref_tables) = cPickle.load(index)
+                return True
+        except IOError:
+            return False
+
+    def index_header(self, srcrefs):
+        stat = os.stat(srcrefs)
+        return INDEX_HEADER.format(size=stat.st_size,
+                                   mtime=stat.st_mtime, order=self.order)
+
+    def load_srcrefs(self, srcrefs, ipath=None):
+        """load sources and references, or their tables from the index ipath
+        if it is up to date; otherwise the index is saved after loading.
+        Only the tables used for scoring are kept in the index."""
+        if ipath and self.load_index(srcrefs, ipath):
+            return
+        self.load_sources(srcrefs)
+        self.load_references(srcrefs)
+        if ipath:
+            self.save_index(srcrefs, ipath)
+
+    def get_ngram_id_counts(self, sentence, n):
+        """get counts of ngram ids of order n, skipping ngrams which are
+        neither in the sources nor the references"""
+        ngram_ids = self.ngram_ids
+        counts = {}
+        for i in xrange(len(sentence) + 1 - n):
+            ngram_id = ngram_ids.get(tuple(sentence[i:i + n]))
+            if ngram_id is not None:
+                counts[ngram_id] = counts.get(ngram_id, 0) + 1
+        return counts
+
+    def get_ngram_overlap(self, counts, ids, ref_counts):
+        """sum of clipped counts of ngram ids, as sum((a & b).values())"""
+        get = counts.get
+        overlap = 0
+        for ngram_id, count in izip(ids, ref_counts):
+            h_count = get(ngram_id)
+            if h_count is not None:
+                overlap += h_count if h_count < count else count
+        return overlap
+
     def get_ngram_counts(self, sentence, n):
         """get ngrams of order n for a tokenized sentence"""
         return Counter([tuple(sentence[i:i + n])
@@ -107,13 +204,12 @@ class GLEU:
 
         for n in xrange(1, self.order + 1):
             h_ngrams = self.this_h_ngrams[n - 1]
-            s_ngrams = self.all_s_ngrams[i][n - 1]
-            r_ngrams = self.get_ngram_counts(self.refs[i][r_ind], n)
-
-            s_ngram_diff = self.get_ngram_diff(s_ngrams, r_ngrams)
+            r_ids, r_counts, diff_ids, diff_counts = \
+                self.ref_tables[i][r_ind][n - 1]
 
             yield max(
-                [sum((h_ngrams & r_ngrams).values()) - sum((h_ngrams & s_ngram_diff).values()), 0])
+                [self.get_ngram_overlap(h_ngrams, r_ids, r_counts) -
+                 self.get_ngram_overlap(h_ngrams, diff_ids, diff_counts), 0])
 
             yield max([hlen + 1 - n, 0])
 
@@ -143,14 +239,131 @@ class GLEU:
                 '%f' % std,
                 '(%.3f,%.3f)' % (ci[0], ci[1])]
 
+    def reference_indices(self, num_iterations, num_sents):
+        """matrix of reference indices drawn for each iteration and sentence,
+        the same as random.randint() gives after random.seed(j * 101)"""
+        indices = np.empty((num_iterations, num_sents), dtype=np.intp)
+        for j in range(num_iterations):
+            # seeding with an array initializes Mersenne Twister by
+            # init_by_array() as random.seed() does, and random_sample()
+            # generates the same doubles as random.random()
+            rng = np.random.RandomState([j * 101])
+            indices[j] = (rng.random_sample(num_sents) *
+                          self.num_refs).astype(np.intp)
+        return indices
+
+    def hypothesis_stats(self, hyp, start=0, end=None):
+        """statistics of sentences start to end of hyp against each of their
+        references, as a (sentences x refs x stats) array"""
+        end = len(hyp) if end is None else end
+        stats = np.zeros((end - start, self.num_refs, 2 * self.order + 2),
+                         dtype=np.int64)
+        for i in xrange(start, end):
+            self.load_hypothesis_sentence(hyp[i])
+            for r in range(self.num_refs):
+                stats[i - start, r] = list(self.gleu_stats(i, r_ind=r))
+        return stats
+
+    def hypotheses_stats(self, i, hypotheses):
+        """statistics of several hypotheses of the i-th sentence, e.g. from
+        an n-best list, against each of its references, as a
+        (hypotheses x refs x stats) array. The reference tables of the
+        sentence are turned into one count matrix over the n-grams they
+        contain, and the clipped counts of all hypotheses are taken from it
+        at once."""
+        tables = self.ref_tables[i]
+        columns = {}
+        for orders in tables:
+            for table in orders:
+                for ngram_id in table[0] + table[2]:
+                    columns.setdefault(ngram_id, len(columns))
+
+        # reference and diff counts by reference, order and n-gram
+        ref_counts = np.zeros((len(tables), self.order, 2, len(columns)),
+                              dtype=np.int64)
+        for r, orders in enumerate(tables):
+            for n, (r_ids, r_cnts, diff_ids, diff_cnts) in enumerate(orders):
+                ref_counts[r, n, 0, [columns[k] for k in r_ids]] = r_cnts
+                ref_counts[r, n, 1, [columns[k] for k in diff_ids]] = diff_cnts
+
+        hyp_counts = np.zeros((len(hypotheses), len(columns)), dtype=np.int64)
+        hlens = np.array([len(h) for h in hypotheses], dtype=np.int64)
+        ngram_ids = self.ngram_ids
+        for h, hypothesis in enumerate(hypotheses):
+            counts = {}
+            for n in range(1, self.order + 1):
+                for k in xrange(len(hypothesis) + 1 - n):
+                    col = columns.get(ngram_ids.get(tuple(hypothesis[k:k + n])))
+                    if col is not None:
+                        counts[col] = counts.get(col, 0) + 1
+            hyp_counts[h, counts.keys()] = counts.values()
+
+        clipped = np.minimum(hyp_counts[:, None, None, None, :],
+                             ref_counts[None]).sum(axis=-1)
+        stats = np.zeros((len(hypotheses), len(tables), 2 * self.order + 2),
+                         dtype=np.int64)
+        stats[:, :, 0] = hlens[:, None]
+        stats[:, :, 1] = self.rlens[i]
+        stats[:, :, 2::2] = np.maximum(clipped[..., 0] - clipped[..., 1], 0)
+        stats[:, :, 3::2] = np.maximum(
+            hlens[:, None] + 1 - np.arange(1, self.order + 1), 0)[:, None, :]
+        return stats
+
+    def bootstrap(self, stats, num_iterations=500, per_sent=True):
+        """GLEU results of statistics from hypothesis_stats(), with the
+        totals of all iterations summed by NumPy"""
+        if per_sent:
+            return [self.get_gleu_stats([self.gleu(s, smooth=True)
+                                         for s in sent_stats.tolist()])
+                    for sent_stats in stats]
+        indices = self.reference_indices(num_iterations, len(stats))
+        iter_stats = stats[np.arange(len(stats)), indices].sum(axis=1)
+        return [self.get_gleu_stats([self.gleu(s)
+                                     for s in iter_stats.tolist()])]
+
+    def run_vectorized(self, hyp, num_iterations=500, n=4, per_sent=True):
+        """run_iterations() with statistics of each sentence and reference
+        stored in a (sentences x refs x stats) array"""
+        return self.bootstrap(self.hypothesis_stats(hyp), num_iterations,
+                              per_sent)
+
+    def run_parallel(self, hpaths, jobs, num_iterations=500, per_sent=True,
+                     chunk_size=CHUNK_SIZE):
+        """score hypothesis files in forked worker processes, which share
+        the loaded references, and yield (hpath, results) as run_iterations()
+        gives. Each task is a range of chunk_size sentences of one file and
+        the statistics of all ranges of a file are joined before bootstrap."""
+        global _pool_data
+        hyps = [read_hypothesis(hpath) for hpath in hpaths]
+        tasks = [(h, start, min(start + chunk_size, len(hyp)))
+                 for h, hyp in enumerate(hyps)
+                 for start in xrange(0, len(hyp), chunk_size)]
+        _pool_data = self, hyps
+        pool = multiprocessing.Pool(jobs)
+        chunks = pool.imap(hypothesis_stats_chunk, tasks)
+        for h, hpath in enumerate(hpaths):
+            stats = [next(chunks) for task in tasks if task[0] == h]
+            if stats:
+                stats = np.concatenate(stats)
+            else:
+                stats = self.hypothesis_stats(hyps[h])
+            yield hpath, self.bootstrap(stats, num_iterations, per_sent)
+        pool.close()
+        pool.join()
+
     def run_iterations(self, num_iterations=500, n=4,
                        hypothesis='answer.txt',
-                       debug=False, per_sent=True):
+                       debug=False, per_sent=True, vectorized=False):
         """run specified number of iterations of GLEU, choosing a reference
         for each sentence at random"""
 
-        instream = sys.stdin if hypothesis == '-' else open(hypothesis)
-        hyp = [line.split() for line in instream]
+        hyp = read_hypothesis(hypothesis)
+
+        if vectorized and not debug:
+            for result in self.run_vectorized(hyp, num_iterations, n,
+                                              per_sent):
+                yield result
+            return
 
         # first generate a random list of indices, using a different seed
         # for each iteration
@@ -200,25 +413,73 @@ class GLEU:
         if not per_sent:
             yield self.get_gleu_stats([self.gleu(stats) for stats in iter_stats])
 
+_pool_data = None
+
+
+def hypothesis_stats_chunk(task):
+    gleu_calculator, hyps = _pool_data
+    h, start, end = task
+    return gleu_calculator.hypothesis_stats(hyps[h], start, end)
+
+
+def read_hypothesis(hypothesis):
+    instream = sys.stdin if hypothesis == '-' else open(hypothesis)
+    return [line.split() for line in instream]
+
+
+def benchmark(gleu_calculator, hpaths, num_iterations, per_sent):
+    """compares the results and speed of the list-based and vectorized
+    bootstrap for each hypothesis file"""
+    for hpath in hpaths:
+        results, times = [], []
+        for vectorized in (False, True):
+            start = time.time()
+            results.append(list(gleu_calculator.run_iterations(
+                num_iterations=num_iterations, hypothesis=hpath,
+                per_sent=per_sent, vectorized=vectorized)))
+            times.append(time.time() - start)
+        print hpath
+        print 'lists: %.2fs, numpy: %.2fs (%.1fx faster), same results: %s' \
+            % (times[0], times[1], times[0] / max(times[1], 1e-6),
+               results[0] == results[1])
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--srcrefs', required=True, help='file with tab-separated src and ref(s)')
     parser.add_argument('--hyp', nargs='*', required=True, help='hyp file(s)')
+    parser.add_argument('--index', help='file with prepared n-gram tables of srcrefs,'
+                        ' created if missing or outdated')
     parser.add_argument('-n', type=int, default=4, help='n-gram order')
     parser.add_argument('--iter', type=int, default=500, help='number of GLEU iterations')
     parser.add_argument('--sent', default=False, action='store_true', help='sentence level scores')
     parser.add_argument('-d', '--debug', default=False, action='store_true', help='debug')
+    parser.add_argument('--vectorized', default=False, action='store_true',
+                        help='sum bootstrap iterations with NumPy')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of worker processes, vectorized if more than 1')
+    parser.add_argument('--benchmark', default=False, action='store_true',
+                        help='compare speed of list-based and vectorized iterations')
     args = parser.parse_args()
 
     """get sentence-level gleu scores"""
     sys.stderr.write('Running GLEU...\n')
     gleu_calculator = GLEU(args.n)
-    gleu_calculator.load_sources(args.srcrefs)
-    gleu_calculator.load_references(args.srcrefs)
+    gleu_calculator.load_srcrefs(args.srcrefs, args.index)
+    if args.benchmark:
+        benchmark(gleu_calculator, args.hyp, args.iter, args.sent)
+        sys.exit(0)
+    if args.jobs > 1:
+        for hpath, results in gleu_calculator.run_parallel(
+                args.hyp, args.jobs, num_iterations=args.iter,
+                per_sent=args.sent):
+            print hpath
+            print results
+        sys.exit(0)
     for hpath in args.hyp:
         print hpath
         print [g for g in gleu_calculator.run_iterations(num_iterations=args.iter,
                                                          hypothesis=hpath,
                                                          debug=args.debug,
-                                                         per_sent=args.sent)]
+                                                         per_sent=args.sent,
+                                                         vectorized=args.vectorized)]
@@ -0,0 +1,325 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+"""
+Reader of M2 files shared by m2scorer_fork and m2_tok/convert_m2_tok.py.
+Sentences and edits are kept in records with __slots__ instead of dicts.
+
+Byte offsets of all sentences are stored in an index file next to the M2
+file, {m2}.idx, which is rebuilt whenever the M2 file changes. With the
+index, a large file can be split into shards, sampled or accessed by
+sentence number without parsing it. Gzipped files can only be iterated.
+
+usage: ./m2_corpus.py corpus.m2 --count
+       ./m2_corpus.py corpus.m2 --shard 3/16 > corpus.3.m2
+       ./m2_corpus.py corpus.m2 --sample 1000 --seed 7 > sample.m2
+       ./m2_corpus.py corpus.m2 --ids 0 5 42
+       ./m2_corpus.py corpus.m2 --benchmark
+"""
+
+import os
+import sys
+import gzip
+import time
+import array
+import random
+import argparse
+import resource
+
+INDEX_SUFFIX = '.idx'
+INDEX_HEADER = 'M2INDEX {size} {mtime!r}\n'
+
+
+class M2Edit(object):
+    """Edit from an 'A' line. Fields are kept as strings, except for token
+    offsets."""
+
+    __slots__ = ('start', 'end', 'category', 'correction', 'required',
+                 'comment', 'annotator')
+
+    def __init__(self, start, end, category, correction, required, comment,
+                 annotator):
+        self.start = start
+        self.end = end
+        self.category = category
+        self.correction = correction
+        self.required = required
+        self.comment = comment
+        self.annotator = annotator
+
+    @classmethod
+    def parse(cls, line):
+        fields = line.strip()[2:].split('|||')
+        offsets = fields[0].split()
+        return cls(int(offsets[0]), int(offsets[1]), *fields[1:6])
+
+    def copy(self):
+        return M2Edit(*self.__getstate__())
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __str__(self):
+        return "A %i %i|||%s|||%s|||%s|||%s|||%s" % self.__getstate__()
+
+    def __repr__(self):
+        return "M2Edit(%r)" % str(self)
+
+
+class M2Sentence(object):
+    """Source sentence with its edits. A block of an M2 file may contain
+    several 'S' lines, which are all kept in sources. The 'A' lines of the
+    whole block are kept in block_edits, as the scorer needs them, while
+    edits are only those following the last 'S' line."""
+
+    __slots__ = ('sources', 'block_edits', 'first_edit')
+
+    def __init__(self, sources, block_edits, first_edit=0):
+        self.sources = sources
+        self.block_edits = block_edits
+        self.first_edit = first_edit
+
+    @property
+    def text(self):
+        return self.sources[-1]
+
+    @property
+    def edits(self):
+        return self.block_edits[self.first_edit:]
+
+    def __getstate__(self):
+        return self.sources, self.block_edits, self.first_edit
+
+    def __setstate__(self, state):
+        self.sources, self.block_edits, self.first_edit = state
+
+    def __str__(self):
+        return ''.join(["S %s\n" % source for source in self.sources]
+                       + ["%s\n" % edit for edit in self.block_edits])
+
+    def __repr__(self):
+        return "M2Sentence(%r, %r, %r)" % self.__getstate__()
+
+
+def parse_block(lines):
+    """Parses lines of a block between empty lines. Lines other than 'S'
+    and 'A' lines are ignored."""
+    sources = []
+    edits = []
+    first_edit = 0
+    for line in lines:
+        if line.startswith('S '):
+            sources.append(line[2:].rstrip())
+            first_edit = len(edits)
+        elif line.startswith('A '):
+            edits.append(M2Edit.parse(line))
+    return M2Sentence(tuple(sources), tuple(edits), first_edit)
+
+
+def each_block(m2_io):
+    """Yields lists of lines of non-empty blocks."""
+    block = []
+    for line in m2_io:
+        if line.strip():
+            block.append(line)
+        elif block:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+class M2Corpus(object):
+    """Sentences of an M2 file. Iterating parses the file sequentially,
+    while len(), indexing and the shard and sample methods use the index."""
+
+    def __init__(self, path, save_index=True):
+        self.path = path
+        self.save_index = save_index
+        self.offsets = None
+        self.m2_io = None
+
+    def __iter__(self):
+        with open_m2(self.path) as m2_io:
+            for block in each_block(m2_io):
+                yield parse_block(block)
+
+    def __len__(self):
+        return len(self.index())
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        return parse_block(self.raw(i).splitlines(True))
+
+    def raw(self, i):
+        """Returns the lines of the i-th sentence as they are in the file,
+        without the following empty line."""
+        offsets = self.index()
+        if self.m2_io is None:
+            self.m2_io = open(self.path, 'rb')
+        self.m2_io.seek(offsets[i])
+        lines = []
+        for line in iter(self.m2_io.readline, ''):
+            if not line.strip():
+                break
+            lines.append(line)
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        return ''.join(lines)
+
+    def sentences(self, ids):
+        for i in ids:
+            yield self[i]
+
+    def shard(self, k, n):
+        """Range of sentence numbers of the k-th of n contiguous shards."""
+        size = len(self)
+        return xrange(k * size // n, (k + 1) * size // n)
+
+    def sample(self, size, seed=0):
+        """Sorted sentence numbers of a random sample."""
+        ids = random.Random(seed).sample(xrange(len(self)),
+                                         min(size, len(self)))
+        return sorted(ids)
+
+    def index(self):
+        if self.offsets is None:
+            if self.path.endswith('.gz'):
+                raise ValueError("Gzipped M2 files cannot be indexed: %s"
+                                 % self.path)
+            self.offsets = load_index(self.path)
+            if self.offsets is None:
+                self.offsets = build_index(self.path)
+                if self.save_index:
+                    save_index(self.path, self.offsets)
+        return self.offsets
+
+    def close(self):
+        if self.m2_io is not None:
+            self.m2_io.close()
+            self.m2_io = None
+
+
+def build_index(path):
+    """Returns byte offsets of the first lines of all blocks."""
+    offsets = array.array('l')
+    offset = 0
+    in_block = False
+    with open(path, 'rb') as m2_io:
+        for line in m2_io:
+            if line.strip():
+                if not in_block:
+                    offsets.append(offset)
+                    in_block = True
+            else:
+                in_block = False
+            offset += len(line)
+    return offsets
+
+
+def index_header(path):
+    stat = os.stat(path)
+    return INDEX_HEADER.format(size=stat.st_size, mtime=stat.st_mtime)
+
+
+def load_index(path):
+    """Returns offsets from the index file, or None if it is missing or
+    older than the M2 file."""
+    try:
+        with open(path + INDEX_SUFFIX, 'rb') as index_io:
+            if index_io.readline() != index_header(path):
+                return None
+            offsets = array.array('l')
+            offsets.fromstring(index_io.read())
+            return offsets
+    except IOError:
+        return None
+
+
+def save_index(path, offsets):
+    try:
+        with open(path + INDEX_SUFFIX, 'wb') as index_io:
+            index_io.write(index_header(path))
+            offsets.tofile(index_io)
+    except IOError as exc:
+        print >> sys.stderr, "Index not saved:", exc
+
+
+def open_m2(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def peak_memory():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def benchmark(corpus):
+    """Reports the time and memory needed to parse the corpus, to build
+    and load the index, and to access sentences by number."""
+    start, memory = time.time(), peak_memory()
+    sentences = list(corpus)
+    print "Parsed {} sentences, {} edits in {:.2f}s, {:.1f} MB".format(
+        len(sentences), sum(len(s.edits) for s in sentences),
+        time.time() - start, (peak_memory() - memory) / 1024.0)
+    del sentences
+
+    start = time.time()
+    offsets = build_index(corpus.path)
+    print "Built index in {:.2f}s".format(time.time() - start)
+    save_index(corpus.path, offsets)
+    start = time.time()
+    load_index(corpus.path)
+    print "Loaded index in {:.3f}s".format(time.time() - start)
+
+    ids = corpus.sample(1000)
+    start = time.time()
+    for _ in corpus.sentences(ids):
+        pass
+    print "Read {} random sentences in {:.3f}s".format(
+        len(ids), time.time() - start)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Prints sentences of an M2 file using its index.")
+    parser.add_argument("m2_file", help="M2 file")
+    parser.add_argument(
+        "--count", help="print the number of sentences", action='store_true')
+    parser.add_argument("--shard", help="print the k-th of n shards, as k/n")
+    parser.add_argument(
+        "--sample", help="print a random sample of sentences", type=int)
+    parser.add_argument(
+        "--seed", help="random seed for --sample", type=int, default=0)
+    parser.add_argument(
+        "--ids", help="print sentences with these numbers", type=int,
+        nargs='+')
+    parser.add_argument(
+        "--benchmark", help="report parsing and indexing speed",
+        action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    corpus = M2Corpus(args.m2_file)
+    if args.benchmark:
+        benchmark(corpus)
+    elif args.count:
+        print len(corpus)
+    else:
+        if args.shard:
+            k, n = [int(x) for x in args.shard.split('/')]
+            ids = corpus.shard(k, n)
+        elif args.sample:
+            ids = corpus.sample(args.sample, args.seed)
+        else:
+            ids = args.ids or xrange(len(corpus))
+        for i in ids:
+            sys.stdout.write(corpus.raw(i) + '\n')
+    corpus.close()
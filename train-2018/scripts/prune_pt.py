@@ -0,0 +1,242 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+"""
+Prunes a Moses phrase table sorted by source phrases, e.g. phrase-table.0-0.gz
+from train-model.perl. Phrase pairs are removed if their joint count or score
+are below thresholds, if they are not significant, or if they are not among
+the top-k translations of their source phrase. Pairs with identical source
+and target are always kept, since the correction model relies on them for
+copying the input.
+
+Significance is the negative log p-value of Fisher's exact test as proposed
+by Johnson et al. (2007). Unlike sigtest-filter, it is computed from the
+phrase counts stored in the table instead of sentence co-occurrences, which
+needs no suffix arrays but counts phrases repeated within a sentence several
+times. The thresholds 'a+e' and 'a-e' prune or keep pairs seen only once.
+
+usage: ./prune_pt.py -i phrase-table.gz -o pruned.gz --top-k 30 --min-count 2
+"""
+
+import io
+import sys
+import gzip
+import json
+import time
+import argparse
+import itertools
+
+from math import exp, log, log1p, lgamma
+
+# order of scores in Moses phrase tables: p(f|e), lex(f|e), p(e|f), lex(e|f)
+SCORE_COLUMN = 2
+EPSILON = 0.01
+# relative size of hypergeometric terms below which tails are not summed
+TAIL_EPSILON = 1e-12
+LOG_TAIL_EPSILON = log(TAIL_EPSILON)
+
+
+def main():
+    args = parse_args()
+    in_io = open_input(args.input)
+    if args.output and args.output.endswith('.gz'):
+        out_io = gzip.open(args.output, 'wb')
+    else:
+        out_io = open(args.output, 'w') if args.output else sys.stdout
+
+    threshold = None
+    if args.significance is not None:
+        if not args.corpus_size:
+            sys.exit("Significance pruning requires --corpus-size")
+        threshold = significance_threshold(args.significance,
+                                           args.corpus_size)
+
+    stats = dict.fromkeys(['lines_in', 'lines_out', 'sources_in',
+                           'sources_out', 'bytes_in', 'bytes_out', 'count',
+                           'prob', 'significance', 'top_k'], 0)
+    start = time.time()
+
+    for _, lines in itertools.groupby(iter(in_io.readline, ''),
+                                           key=source_phrase):
+        pairs = [PhrasePair(line, args.column) for line in lines]
+        kept = prune(pairs, args, threshold, stats)
+
+        stats['lines_in'] += len(pairs)
+        stats['lines_out'] += len(kept)
+        stats['sources_in'] += 1
+        stats['sources_out'] += 1 if kept else 0
+        stats['bytes_in'] += sum(len(pair.line) for pair in pairs)
+        stats['bytes_out'] += sum(len(pair.line) for pair in kept)
+        for pair in kept:
+            out_io.write(pair.line)
+
+    if out_io is not sys.stdout:
+        out_io.close()
+    stats['time'] = round(time.time() - start, 3)
+
+    print_report(stats)
+    if args.report:
+        with open(args.report, 'w') as report_io:
+            json.dump(stats, report_io, indent=2, sort_keys=True)
+
+
+class PhrasePair(object):
+    """Line of a phrase table with the fields used for pruning."""
+
+    def __init__(self, line, column):
+        fields = line.rstrip('\n').split(' ||| ')
+        self.line = line
+        self.identity = fields[0] == fields[1]
+        self.score = float(fields[2].split()[column])
+        # counts of target, source and the pair, if present
+        counts = fields[4].split() if len(fields) > 4 else []
+        if len(counts) >= 3:
+            self.counts = [float(c) for c in counts[:3]]
+        else:
+            self.counts = None
+
+
+def prune(pairs, args, threshold, stats):
+    kept = []
+    for pair in pairs:
+        if pair.identity:
+            kept.append(pair)
+        elif args.min_count and pair.counts \
+                and pair.counts[2] < args.min_count:
+            stats['count'] += 1
+        elif args.min_prob and pair.score < args.min_prob:
+            stats['prob'] += 1
+        elif threshold is not None and pair.counts \
+                and significance(pair.counts, args.corpus_size) < threshold:
+            stats['significance'] += 1
+        else:
+            kept.append(pair)
+
+    if args.top_k:
+        ranked = sorted((pair for pair in kept if not pair.identity),
+                        key=lambda pair: -pair.score)
+        pruned = set(id(pair) for pair in ranked[args.top_k:])
+        stats['top_k'] += len(pruned)
+        kept = [pair for pair in kept if id(pair) not in pruned]
+    return kept
+
+
+def significance(counts, corpus_size):
+    """Negative log p-value of Fisher's exact test that the source and target
+    phrase co-occur more often than by chance."""
+    count_t, count_s, count_st = [int(round(c)) for c in counts]
+    count_t = max(count_t, count_st)
+    count_s = max(count_s, count_st)
+    corpus_size = max(corpus_size, count_s + count_t - count_st)
+
+    def log_prob(k):
+        return log_choose(count_s, k) \
+            + log_choose(corpus_size - count_s, count_t - k) - log_total
+
+    log_total = log_choose(corpus_size, count_t)
+    mode = (count_s + 1) * (count_t + 1) // (corpus_size + 2)
+    if count_st >= mode:
+        # probabilities decrease from count_st upwards
+        return -log_tail(log_prob, xrange(count_st, min(count_s, count_t) + 1))
+
+    # the lower tail decreases from count_st - 1 downwards
+    low = max(0, count_s + count_t - corpus_size)
+    if count_st <= low:
+        return 0.0
+    lower = exp(log_tail(log_prob, xrange(count_st - 1, low - 1, -1)))
+    return -log1p(-min(lower, 1.0))
+
+
+def log_tail(log_prob, ks):
+    """Log of the sum of probabilities that decrease monotonically along ks.
+    Summing stops once the terms fall below TAIL_EPSILON of the first one,
+    so that frequent phrases do not need up to millions of terms."""
+    top = None
+    total = 0.0
+    for k in ks:
+        term = log_prob(k)
+        if top is None:
+            top = term
+        elif term - top < LOG_TAIL_EPSILON:
+            break
+        total += exp(term - top)
+    return top + log(total)
+
+
+def significance_threshold(value, corpus_size):
+    if value in ('a+e', 'a-e'):
+        # -log p-value of a pair seen once with phrases seen once is log(N)
+        sign = 1 if value == 'a+e' else -1
+        return log(corpus_size) + sign * EPSILON
+    return float(value)
+
+
+def log_choose(n, k):
+    return lgamma(n + 1) - lgamma(k + 1) - lgamma(n - k + 1)
+
+
+def source_phrase(line):
+    return line.split(' ||| ', 1)[0]
+
+
+def open_input(path):
+    if path is None:
+        return sys.stdin
+    with open(path, 'rb') as magic_io:
+        is_gzip = magic_io.read(2) == '\x1f\x8b'
+    if is_gzip:
+        return io.BufferedReader(gzip.open(path))
+    return open(path)
+
+
+def print_report(stats):
+    def ratio(key):
+        return 100.0 * stats[key + '_out'] / max(stats[key + '_in'], 1)
+
+    print >> sys.stderr, "Phrase pairs: {} -> {} ({:.1f}%)".format(
+        stats['lines_in'], stats['lines_out'], ratio('lines'))
+    print >> sys.stderr, "Source phrases: {} -> {} ({:.1f}%)".format(
+        stats['sources_in'], stats['sources_out'], ratio('sources'))
+    print >> sys.stderr, "Size: {:.1f} MB -> {:.1f} MB ({:.1f}%)".format(
+        stats['bytes_in'] / 1024.0 / 1024.0,
+        stats['bytes_out'] / 1024.0 / 1024.0, ratio('bytes'))
+    print >> sys.stderr, "Pruned by count: {}, probability: {}," \
+        " significance: {}, top-k: {}".format(
+            stats['count'], stats['prob'], stats['significance'],
+            stats['top_k'])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Prunes phrase table sorted by source phrases.")
+    parser.add_argument(
+        "-i", "--input", help="phrase table, plain or gzipped, default: stdin")
+    parser.add_argument(
+        "-o", "--output",
+        help="output file, gzipped if it ends with .gz, default: stdout")
+    parser.add_argument(
+        "-k", "--top-k",
+        help="keep k best translations of each source phrase",
+        type=int)
+    parser.add_argument(
+        "-c", "--column",
+        help="score used for --top-k and --min-prob, default: 2 (p(e|f))",
+        type=int,
+        default=SCORE_COLUMN)
+    parser.add_argument(
+        "--min-count", help="minimum joint count of a pair", type=float)
+    parser.add_argument(
+        "--min-prob", help="minimum score in --column", type=float)
+    parser.add_argument(
+        "--significance",
+        help="minimum negative log p-value of a pair, or a+e or a-e")
+    parser.add_argument(
+        "--corpus-size",
+        help="number of training sentence pairs, required by --significance",
+        type=int,
+        default=0)
+    parser.add_argument("--report", help="write statistics as JSON")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,32 +1,153 @@
 #!/usr/bin/python
 # -*- encoding: utf-8 -*-
 
+import io
 import os
 import sys
+import gzip
+import time
+import zlib
+import collections
+import multiprocessing
 from math import log, exp
 from kenlm import LanguageModel
 
-lm = None
-lm_prob = None
-model = None
+lms = []
+lm_probs = []
+scorers = []
+jobs = 1
+cache_size = 100000
+input_path = None
+output_path = None
+compress = False
+
+# size of a block of lines sent to a worker process
+CHUNK_BYTES = 4 * 1024 * 1024
 
 
 def main():
+    global scorers
     parse_args()
-    model = LanguageModel(lm)
+    # models are loaded once and shared with forked workers
+    scorers = [PhraseScorer(LanguageModel(path), cache_size) for path in lms]
 
-    for line in sys.stdin:
-        s, t, weights, align, rest = line.strip().split(' ||| ')
+    in_io = open_input(input_path)
+    out_io = open(output_path, 'wb') if output_path else sys.stdout
 
-        if s == t:
-            weights += ' 1'
+    start = time.time()
+    count = 0
+    stats = collections.Counter()
+    if jobs > 1:
+        chunks = process_parallel(each_chunk(in_io), jobs)
+    else:
+        chunks = (add_lm_prob_chunk(c) for c in each_chunk(in_io))
+    for lines, text, chunk_stats in chunks:
+        out_io.write(text)
+        count += lines
+        stats.update(chunk_stats)
+
+    if out_io is not sys.stdout:
+        out_io.close()
+
+    elapsed = time.time() - start
+    print >> sys.stderr, "Processed %d lines in %.1fs (%.1f lines/s)" \
+        % (count, elapsed, count / max(elapsed, 1e-6))
+    for kind in ('source', 'target'):
+        hits, misses = stats[kind + '_hits'], stats[kind + '_misses']
+        print >> sys.stderr, "%s scores: %d cached, %d computed " \
+            "(%.1f%% hit rate)" % (kind.capitalize(), hits, misses,
+                                   100.0 * hits / max(hits + misses, 1))
+
+
+class PhraseScorer(object):
+    """Scores phrases with the LM. The score of the last source phrase is
+    reused, since phrase tables are sorted by source, and target scores are
+    kept in a bounded LRU cache."""
+
+    def __init__(self, model, size):
+        self.model = model
+        self.size = size
+        self.source = None
+        self.targets = collections.OrderedDict()
+        self.stats = collections.Counter()
+
+    def score_source(self, s):
+        if self.source is not None and self.source[0] == s:
+            self.stats['source_hits'] += 1
+        else:
+            self.stats['source_misses'] += 1
+            self.source = (s, self.model.score(s), s.count(' ') + 1)
+        return self.source[1:]
+
+    def score_target(self, t):
+        result = self.targets.pop(t, None)
+        if result is None:
+            self.stats['target_misses'] += 1
+            result = (self.model.score(t), t.count(' ') + 1)
+            if len(self.targets) >= self.size:
+                self.targets.popitem(last=False)
         else:
-            s_score, t_score = model.score(s), model.score(t)
-            s_len, t_len = s.count(' ') + 1, t.count(' ') + 1
+            self.stats['target_hits'] += 1
+        self.targets[t] = result
+        return result
 
-            weights += " %.6f" % lm_prob(s_score, t_score, s_len, t_len)
 
-        print ' ||| '.join([s, t, weights, align, rest])
+def add_lm_prob(line):
+    s, t, weights, align, rest = line.strip().split(' ||| ')
+
+    if s == t:
+        weights += ' 1' * (len(scorers) * len(lm_probs))
+    else:
+        for scorer in scorers:
+            s_score, s_len = scorer.score_source(s)
+            t_score, t_len = scorer.score_target(t)
+
+            for lm_prob in lm_probs:
+                weights += " %.6f" % lm_prob(s_score, t_score, s_len, t_len)
+
+    return ' ||| '.join([s, t, weights, align, rest])
+
+def add_lm_prob_chunk(lines):
+    before = sum((scorer.stats for scorer in scorers), collections.Counter())
+    text = ''.join(add_lm_prob(line) + '\n' for line in lines)
+    stats = sum((scorer.stats for scorer in scorers), collections.Counter())
+    stats.subtract(before)
+    if compress:
+        # chunks are compressed by workers as separate gzip members, which
+        # concatenated form a valid gzip file
+        gz = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        text = gz.compress(text) + gz.flush()
+    return len(lines), text, stats
+
+def open_input(path):
+    if path is None:
+        return sys.stdin
+    with open(path, 'rb') as magic_io:
+        is_gzip = magic_io.read(2) == '\x1f\x8b'
+    if is_gzip:
+        return io.BufferedReader(gzip.open(path), CHUNK_BYTES)
+    return open(path)
+
+def each_chunk(io):
+    while True:
+        lines = io.readlines(CHUNK_BYTES)
+        if not lines:
+            break
+        yield lines
+
+def process_parallel(chunks, num_jobs):
+    """Processes chunks in forked workers and yields results in the input
+    order. Only a few chunks are read ahead to keep memory bounded."""
+    pool = multiprocessing.Pool(num_jobs)
+    pending = collections.deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(add_lm_prob_chunk, (chunk, )))
+        if len(pending) >= 2 * num_jobs:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+    pool.close()
+    pool.join()
 
 def lm_prob_arithmetic(s_score, t_score, s_len, t_len):
     return exp(t_score + log(s_len) - s_score - log(t_len))
@@ -40,25 +161,62 @@ def lm_prob_raw(s_score, t_score, s_len, t_len):
     return exp(t_score - s_score)
 
 
+LM_PROBS = {
+    'raw': lm_prob_raw,
+    'arithmetic': lm_prob_arithmetic,
+    'geometric': lm_prob_geometric,
+}
+
+
 def parse_args():
-    global lm_prob
-    global lm
+    global lm_probs
+    global lms
+    global jobs
+    global cache_size
+    global input_path
+    global output_path
+    global compress
 
     if '-h' in sys.argv or '--help' in sys.argv:
         print "Adds LM-based feature to phrase table."
-        print "usage: zcat phrase-table.gz | ./add_lm_prob.py [-a|-g] | gz"
+        print "usage: zcat phrase-table.gz | ./add_lm_prob.py [-a|-g] [-j 16]" \
+            " [-cache 100000] | gz"
+        print "       ./add_lm_prob.py -lm lm1 [-lm lm2] -f raw,geometric" \
+            " -i phrase-table.gz -o output.gz"
+        print "One feature is added for each LM and each of the features" \
+            " given with -f (raw, arithmetic, geometric)."
         exit(0)
 
-    if '-g' in sys.argv:
-        lm_prob = lm_prob_geometric
-    if '-a' in sys.argv:
-        lm_prob = lm_prob_arithmetic
+    if '-f' in sys.argv:
+        idx = sys.argv.index('-f') + 1
+        lm_probs = [LM_PROBS[name] for name in sys.argv[idx].split(',')]
+    elif '-g' in sys.argv:
+        lm_probs = [lm_prob_geometric]
+    elif '-a' in sys.argv:
+        lm_probs = [lm_prob_arithmetic]
     else:
-        lm_prob = lm_prob_raw
+        lm_probs = [lm_prob_raw]
+
+    for idx, arg in enumerate(sys.argv):
+        if arg == '-lm':
+            lms.append(sys.argv[idx + 1])
+
+    if '-i' in sys.argv:
+        idx = sys.argv.index('-i') + 1
+        input_path = sys.argv[idx]
+
+    if '-o' in sys.argv:
+        idx = sys.argv.index('-o') + 1
+        output_path = sys.argv[idx]
+        compress = output_path.endswith('.gz')
+
+    if '-j' in sys.argv:
+        idx = sys.argv.index('-j') + 1
+        jobs = int(sys.argv[idx])
 
-    if '-lm' in sys.argv:
-        idx = sys.argv.index('-lm') + 1
-        lm = sys.argv[idx]
+    if '-cache' in sys.argv:
+        idx = sys.argv.index('-cache') + 1
+        cache_size = int(sys.argv[idx])
 
 if __name__ == '__main__':
     main()
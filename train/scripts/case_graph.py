@@ -0,0 +1,136 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+"""
+Recases tokenized text with a language model. This is an in-process
+replacement for case_graph.perl and the lazy decoder: every word can be kept
+as it is or lowercased, and the best path through this two-way lattice is
+found with beam search. The LM is loaded once and shared by all worker
+processes.
+
+usage: ./case_graph.py --lm wiki.blm [-t 16] < input.tok > output.tc
+"""
+
+import sys
+import time
+import heapq
+import argparse
+import multiprocessing
+
+from kenlm import LanguageModel, State
+
+THREADS = 16
+BEAM = 10
+BATCH_SIZE = 1000
+
+# weights used by case_graph.perl for lazy
+LM_WEIGHT = 1.0
+OOV_WEIGHT = 1.0
+
+truecaser = None
+
+
+def main():
+    global truecaser
+    args = parse_args()
+
+    print >> sys.stderr, "Loading {}".format(args.lm)
+    truecaser = Truecaser(args.lm, beam=args.beam)
+
+    start = time.time()
+    count = 0
+    pool = multiprocessing.Pool(args.threads)
+    for lines in pool.imap(truecase_batch, each_batch(sys.stdin, args.batch)):
+        for line in lines:
+            print line
+        count += len(lines)
+    pool.close()
+    pool.join()
+
+    elapsed = time.time() - start
+    print >> sys.stderr, "Recased {} lines in {:.1f}s ({:.1f} lines/s)" \
+        .format(count, elapsed, count / max(elapsed, 1e-6))
+
+
+class Truecaser(object):
+    """Chooses the casing of each token using a KenLM language model."""
+
+    def __init__(self, lm, beam=BEAM, lm_weight=LM_WEIGHT,
+                 oov_weight=OOV_WEIGHT):
+        self.model = LanguageModel(lm)
+        self.beam = beam
+        self.lm_weight = lm_weight
+        self.oov_weight = oov_weight
+
+    def truecase(self, sentence):
+        words = sentence.decode('utf-8').split()
+
+        start = State()
+        self.model.BeginSentenceWrite(start)
+        # a hypothesis is (score, LM state, path), where path is a linked
+        # list of (word, previous path) tuples
+        hyps = [(0.0, start, None)]
+
+        for word in words + [u'</s>']:
+            options = [word]
+            if word != u'</s>' and word != word.lower():
+                options.append(word.lower())
+            costs = [self.oov_weight if option not in self.model else 0.0
+                     for option in options]
+
+            # hypotheses with the same LM state are recombined
+            best = {}
+            for score, state, path in hyps:
+                for option, cost in zip(options, costs):
+                    out = State()
+                    new_score = score + cost + self.lm_weight \
+                        * self.model.BaseScore(state, option, out)
+                    if out not in best or best[out][0] < new_score:
+                        best[out] = (new_score, out, (option, path))
+            hyps = heapq.nlargest(self.beam, best.values(),
+                                  key=lambda hyp: hyp[0])
+
+        _, _, path = max(hyps, key=lambda hyp: hyp[0])
+        tokens = []
+        path = path[1]  # skip </s>
+        while path is not None:
+            tokens.append(path[0])
+            path = path[1]
+        return u' '.join(reversed(tokens)).encode('utf-8')
+
+
+def truecase_batch(lines):
+    return [truecaser.truecase(line) for line in lines]
+
+
+def each_batch(io, size):
+    batch = []
+    for line in iter(io.readline, ''):
+        batch.append(line.rstrip('\n'))
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Recases tokenized text with a KenLM language model.")
+    parser.add_argument("--lm", help="path to KenLM model", required=True)
+    parser.add_argument(
+        "-t", "--threads",
+        help="number of worker processes, default: 16",
+        type=int,
+        default=THREADS)
+    parser.add_argument(
+        "-b", "--beam", help="beam size, default: 10", type=int, default=BEAM)
+    parser.add_argument(
+        "--batch",
+        help="number of lines sent to a worker at once",
+        type=int,
+        default=BATCH_SIZE)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,439 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+"""
+Restores casing, special characters and tokenization of the original input
+in the decoder output. This is a single-pass replacement for:
+
+    impose_case.perl orig aln | deescape-special-chars.perl \
+        | impose_tok.perl orig
+
+The decoded text, the alignment and the original input are read in
+lockstep, and blocks of lines can be processed by parallel workers.
+
+usage: ./impose.py [-j 16] orig.txt aln.txt < output.tok > output.txt
+"""
+
+import re
+import sys
+import argparse
+import itertools
+import multiprocessing
+import unicodedata
+
+from bisect import bisect_left
+
+THREADS = 1
+CHUNK_SIZE = 1000
+
+RE_WHITESPACE = re.compile(r'\s', re.UNICODE)
+RE_LETTER = re.compile(r'[a-z]', re.IGNORECASE)
+RE_ESCAPED = re.compile(r'&(bar|#124|lt|gt|bra|ket|quot|apos|#91|#93|amp);')
+RE_SCHEMA_QUOTE = re.compile(r"''\w")
+RE_SCHEMA_COMMA = re.compile(r', .$')
+RE_FINAL_TOKEN = re.compile(r' .$')
+
+ESCAPED_CHARS = {
+    'bar': '|',
+    '#124': '|',
+    'lt': '<',
+    'gt': '>',
+    'bra': '[',
+    'ket': ']',
+    'quot': '"',
+    'apos': "'",
+    '#91': '[',
+    '#93': ']',
+    'amp': '&',
+}
+
+# full case mappings of Perl's uc, ucfirst and lc where they differ from
+# the simple mappings of unicode.upper(), title() and lower()
+FULL_UPPER = {
+    u'\xdf': u'SS', u'\u0149': u'\u02bcN', u'\u01f0': u'J\u030c',
+    u'\u0390': u'\u0399\u0308\u0301', u'\u03b0': u'\u03a5\u0308\u0301',
+    u'\u0587': u'\u0535\u0552', u'\u1e96': u'H\u0331', u'\u1e97': u'T\u0308',
+    u'\u1e98': u'W\u030a', u'\u1e99': u'Y\u030a', u'\u1e9a': u'A\u02be',
+    u'\u1f50': u'\u03a5\u0313', u'\u1f52': u'\u03a5\u0313\u0300',
+    u'\u1f54': u'\u03a5\u0313\u0301', u'\u1f56': u'\u03a5\u0313\u0342',
+    u'\u1f80': u'\u1f08\u0399', u'\u1f81': u'\u1f09\u0399',
+    u'\u1f82': u'\u1f0a\u0399', u'\u1f83': u'\u1f0b\u0399',
+    u'\u1f84': u'\u1f0c\u0399', u'\u1f85': u'\u1f0d\u0399',
+    u'\u1f86': u'\u1f0e\u0399', u'\u1f87': u'\u1f0f\u0399',
+    u'\u1f88': u'\u1f08\u0399', u'\u1f89': u'\u1f09\u0399',
+    u'\u1f8a': u'\u1f0a\u0399', u'\u1f8b': u'\u1f0b\u0399',
+    u'\u1f8c': u'\u1f0c\u0399', u'\u1f8d': u'\u1f0d\u0399',
+    u'\u1f8e': u'\u1f0e\u0399', u'\u1f8f': u'\u1f0f\u0399',
+    u'\u1f90': u'\u1f28\u0399', u'\u1f91': u'\u1f29\u0399',
+    u'\u1f92': u'\u1f2a\u0399', u'\u1f93': u'\u1f2b\u0399',
+    u'\u1f94': u'\u1f2c\u0399', u'\u1f95': u'\u1f2d\u0399',
+    u'\u1f96': u'\u1f2e\u0399', u'\u1f97': u'\u1f2f\u0399',
+    u'\u1f98': u'\u1f28\u0399', u'\u1f99': u'\u1f29\u0399',
+    u'\u1f9a': u'\u1f2a\u0399', u'\u1f9b': u'\u1f2b\u0399',
+    u'\u1f9c': u'\u1f2c\u0399', u'\u1f9d': u'\u1f2d\u0399',
+    u'\u1f9e': u'\u1f2e\u0399', u'\u1f9f': u'\u1f2f\u0399',
+    u'\u1fa0': u'\u1f68\u0399', u'\u1fa1': u'\u1f69\u0399',
+    u'\u1fa2': u'\u1f6a\u0399', u'\u1fa3': u'\u1f6b\u0399',
+    u'\u1fa4': u'\u1f6c\u0399', u'\u1fa5': u'\u1f6d\u0399',
+    u'\u1fa6': u'\u1f6e\u0399', u'\u1fa7': u'\u1f6f\u0399',
+    u'\u1fa8': u'\u1f68\u0399', u'\u1fa9': u'\u1f69\u0399',
+    u'\u1faa': u'\u1f6a\u0399', u'\u1fab': u'\u1f6b\u0399',
+    u'\u1fac': u'\u1f6c\u0399', u'\u1fad': u'\u1f6d\u0399',
+    u'\u1fae': u'\u1f6e\u0399', u'\u1faf': u'\u1f6f\u0399',
+    u'\u1fb2': u'\u1fba\u0399', u'\u1fb3': u'\u0391\u0399',
+    u'\u1fb4': u'\u0386\u0399', u'\u1fb6': u'\u0391\u0342',
+    u'\u1fb7': u'\u0391\u0342\u0399', u'\u1fbc': u'\u0391\u0399',
+    u'\u1fc2': u'\u1fca\u0399', u'\u1fc3': u'\u0397\u0399',
+    u'\u1fc4': u'\u0389\u0399', u'\u1fc6': u'\u0397\u0342',
+    u'\u1fc7': u'\u0397\u0342\u0399', u'\u1fcc': u'\u0397\u0399',
+    u'\u1fd2': u'\u0399\u0308\u0300', u'\u1fd3': u'\u0399\u0308\u0301',
+    u'\u1fd6': u'\u0399\u0342', u'\u1fd7': u'\u0399\u0308\u0342',
+    u'\u1fe2': u'\u03a5\u0308\u0300', u'\u1fe3': u'\u03a5\u0308\u0301',
+    u'\u1fe4': u'\u03a1\u0313', u'\u1fe6': u'\u03a5\u0342',
+    u'\u1fe7': u'\u03a5\u0308\u0342', u'\u1ff2': u'\u1ffa\u0399',
+    u'\u1ff3': u'\u03a9\u0399', u'\u1ff4': u'\u038f\u0399',
+    u'\u1ff6': u'\u03a9\u0342', u'\u1ff7': u'\u03a9\u0342\u0399',
+    u'\u1ffc': u'\u03a9\u0399', u'\ufb00': u'FF', u'\ufb01': u'FI',
+    u'\ufb02': u'FL', u'\ufb03': u'FFI', u'\ufb04': u'FFL', u'\ufb05': u'ST',
+    u'\ufb06': u'ST', u'\ufb13': u'\u0544\u0546', u'\ufb14': u'\u0544\u0535',
+    u'\ufb15': u'\u0544\u053b', u'\ufb16': u'\u054e\u0546',
+    u'\ufb17': u'\u0544\u053d',
+}
+
+FULL_TITLE = {
+    u'\xdf': u'Ss', u'\u0149': u'\u02bcN', u'\u01f0': u'J\u030c',
+    u'\u0390': u'\u0399\u0308\u0301', u'\u03b0': u'\u03a5\u0308\u0301',
+    u'\u0587': u'\u0535\u0582', u'\u1e96': u'H\u0331', u'\u1e97': u'T\u0308',
+    u'\u1e98': u'W\u030a', u'\u1e99': u'Y\u030a', u'\u1e9a': u'A\u02be',
+    u'\u1f50': u'\u03a5\u0313', u'\u1f52': u'\u03a5\u0313\u0300',
+    u'\u1f54': u'\u03a5\u0313\u0301', u'\u1f56': u'\u03a5\u0313\u0342',
+    u'\u1fb2': u'\u1fba\u0345', u'\u1fb4': u'\u0386\u0345',
+    u'\u1fb6': u'\u0391\u0342', u'\u1fb7': u'\u0391\u0342\u0345',
+    u'\u1fc2': u'\u1fca\u0345', u'\u1fc4': u'\u0389\u0345',
+    u'\u1fc6': u'\u0397\u0342', u'\u1fc7': u'\u0397\u0342\u0345',
+    u'\u1fd2': u'\u0399\u0308\u0300', u'\u1fd3': u'\u0399\u0308\u0301',
+    u'\u1fd6': u'\u0399\u0342', u'\u1fd7': u'\u0399\u0308\u0342',
+    u'\u1fe2': u'\u03a5\u0308\u0300', u'\u1fe3': u'\u03a5\u0308\u0301',
+    u'\u1fe4': u'\u03a1\u0313', u'\u1fe6': u'\u03a5\u0342',
+    u'\u1fe7': u'\u03a5\u0308\u0342', u'\u1ff2': u'\u1ffa\u0345',
+    u'\u1ff4': u'\u038f\u0345', u'\u1ff6': u'\u03a9\u0342',
+    u'\u1ff7': u'\u03a9\u0342\u0345', u'\ufb00': u'Ff', u'\ufb01': u'Fi',
+    u'\ufb02': u'Fl', u'\ufb03': u'Ffi', u'\ufb04': u'Ffl', u'\ufb05': u'St',
+    u'\ufb06': u'St', u'\ufb13': u'\u0544\u0576', u'\ufb14': u'\u0544\u0565',
+    u'\ufb15': u'\u0544\u056b', u'\ufb16': u'\u054e\u0576',
+    u'\ufb17': u'\u0544\u056d',
+}
+
+FULL_LOWER = {
+    u'\u0130': u'i\u0307',
+}
+
+RE_FULL_UPPER = re.compile(u'[%s]' % u''.join(FULL_UPPER))
+RE_FULL_LOWER = re.compile(u'[%s]' % u''.join(FULL_LOWER))
+
+
+def main():
+    args = parse_args()
+    orig_io = open(args.orig)
+    aln_io = open(args.aln)
+
+    # readline does not wait for a full buffer, which matters when reading
+    # from pipes in streaming mode
+    lines = itertools.izip(iter(sys.stdin.readline, ''),
+                           iter(orig_io.readline, ''),
+                           iter(aln_io.readline, ''))
+
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        results = pool.imap(impose_chunk, each_chunk(lines, args.chunk))
+    else:
+        pool = None
+        results = itertools.imap(impose_chunk, each_chunk(lines, CHUNK_SIZE))
+
+    for chunk in results:
+        for line in chunk:
+            sys.stdout.write(line + '\n')
+
+    if pool:
+        pool.close()
+        pool.join()
+    orig_io.close()
+    aln_io.close()
+
+
+def impose(trg, src, aln):
+    """Postprocesses a single decoded sentence."""
+    cased = impose_case(trg.decode('utf-8'), src.decode('utf-8'), aln)
+    return impose_tok(deescape(cased.encode('utf-8')), src)
+
+
+def impose_chunk(lines):
+    return [impose(trg.rstrip('\n'), src.rstrip('\n'), aln.rstrip('\n'))
+            for trg, src, aln in lines]
+
+
+def each_chunk(lines, size):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def impose_case(trg, src, aln):
+    """Copies casing of aligned source tokens into the output, as done by
+    impose_case.perl. Takes and returns unicode strings."""
+    src, src_lower = split_lower(src)
+    trg, trg_lower = split_lower(trg)
+    aln = [parse_pair(p) for p in perl_split(aln)]
+
+    done = set()
+    for i, j in aln:
+        if get_token(src_lower, i) == get_token(trg_lower, j):
+            set_token(trg, j, get_token(src, i))
+            done.add(i)
+
+    for i, j in aln:
+        if i in done:
+            continue
+        src_tok = get_token(src, i)
+
+        if '"' in src_tok and not RE_LETTER.search(get_token(trg, j)):
+            set_token(trg, j, src_tok)
+
+        if is_capitalized(src_tok):
+            set_token(trg, j, ucfirst(get_token(trg, j)))
+        elif is_uppercased(src_tok):
+            set_token(trg, j, uc(get_token(trg, j)))
+        elif starts_upper(src_tok):
+            set_token(trg, j, ucfirst(get_token(trg, j)))
+
+        done.add(i)
+
+    if starts_upper(get_token(src, 0)):
+        set_token(trg, 0, ucfirst(get_token(trg, 0)))
+
+    return u' '.join(trg)
+
+
+def deescape(text):
+    """Unescapes special characters like deescape-special-chars.perl."""
+    if '&' not in text:
+        return text
+    return RE_ESCAPED.sub(lambda m: ESCAPED_CHARS[m.group(1)], text)
+
+
+def impose_tok(text, schema):
+    """Restores spaces of the original input, as done by impose_tok.perl.
+    Works on byte strings, character by character."""
+    if RE_SCHEMA_QUOTE.search(schema):
+        text = text.replace('" ', "''", 1)
+    if RE_SCHEMA_COMMA.search(schema):
+        text = RE_FINAL_TOKEN.sub(', .', text, 1)
+    text = text.replace("n 't", " n't")
+
+    chars = list(text)
+    count = 0
+    for hunk in diff(chars, list(schema)):
+        for op, i, char in hunk:
+            if op == '-':
+                count += 1
+            if len(hunk) == 1 and char == ' ':
+                if op == '-':
+                    chars[i] = None
+                if op == '+':
+                    j = i + count
+                    if j >= len(chars):
+                        chars.extend([None] * (j + 1 - len(chars)))
+                    chars[j] = ' ' + (chars[j] or '')
+                    count -= 1
+
+    return ''.join(c for c in chars if c is not None)
+
+
+def diff(a, b):
+    """Returns hunks of (op, index, element) tuples, exactly as diff() from
+    Algorithm::Diff used by impose_tok.perl."""
+    hunks = []
+    hunk = []
+    ai = bi = 0
+    matches = lcs_matches(a, b)
+
+    for ai, bj in enumerate(matches):
+        if bj is None:
+            hunk.append(('-', ai, a[ai]))
+            continue
+        while bi < bj:
+            hunk.append(('+', bi, b[bi]))
+            bi += 1
+        bi += 1
+        if hunk:
+            hunks.append(hunk)
+            hunk = []
+    ai = len(matches)
+
+    while ai < len(a) or bi < len(b):
+        if ai == len(a) and bi < len(b):
+            while bi < len(b):
+                hunk.append(('+', bi, b[bi]))
+                bi += 1
+        if bi == len(b) and ai < len(a):
+            while ai < len(a):
+                hunk.append(('-', ai, a[ai]))
+                ai += 1
+        if ai < len(a):
+            hunk.append(('-', ai, a[ai]))
+            ai += 1
+        if bi < len(b):
+            hunk.append(('+', bi, b[bi]))
+            bi += 1
+
+    if hunk:
+        hunks.append(hunk)
+    return hunks
+
+
+def lcs_matches(a, b):
+    """McIlroy-Hunt LCS as in Algorithm::Diff: returns a list where the i-th
+    element is the index of b matched with a[i] or None. The list ends at the
+    last matched element of a."""
+    matches = {}
+    a_start, a_end = 0, len(a) - 1
+    b_start, b_end = 0, len(b) - 1
+
+    while a_start <= a_end and b_start <= b_end and a[a_start] == b[b_start]:
+        matches[a_start] = b_start
+        a_start += 1
+        b_start += 1
+    while a_start <= a_end and b_start <= b_end and a[a_end] == b[b_end]:
+        matches[a_end] = b_end
+        a_end -= 1
+        b_end -= 1
+
+    # positions of each element of b in descending order
+    positions = {}
+    for j in xrange(b_end, b_start - 1, -1):
+        positions.setdefault(b[j], []).append(j)
+
+    thresh = []
+    links = []
+    for i in xrange(a_start, a_end + 1):
+        if a[i] not in positions:
+            continue
+        k = 0
+        for j in positions[a[i]]:
+            if k and thresh[k] > j and thresh[k - 1] < j:
+                thresh[k] = j
+            else:
+                # replace the next larger threshold with j, searching only
+                # up to the last position, as _replaceNextLargerWith does
+                high = k or len(thresh) - 1
+                if high == -1 or j > thresh[-1]:
+                    thresh.append(j)
+                    k = high + 1
+                else:
+                    k = bisect_left(thresh, j, 0, high + 1)
+                    if k <= high and thresh[k] == j:
+                        k = None
+                    else:
+                        thresh[k] = j
+            if k is not None:
+                link = (links[k - 1] if k else None, i, j)
+                if k < len(links):
+                    links[k] = link
+                else:
+                    links.append(link)
+
+    if thresh:
+        link = links[len(thresh) - 1]
+        while link:
+            matches[link[1]] = link[2]
+            link = link[0]
+
+    if not matches:
+        return []
+    return [matches.get(i) for i in xrange(max(matches) + 1)]
+
+
+def perl_split(text):
+    """Splits on single whitespace characters like Perl's split(/\\s/)."""
+    tokens = RE_WHITESPACE.split(text)
+    while tokens and not tokens[-1]:
+        tokens.pop()
+    return tokens
+
+
+def parse_pair(pair):
+    """Parses an alignment point; missing indices count as 0 like in Perl."""
+    i, _, j = pair.partition('-')
+    return int(i or 0), int(j.partition('-')[0] or 0)
+
+
+def get_token(tokens, i):
+    return tokens[i] if i < len(tokens) else u''
+
+
+def set_token(tokens, i, token):
+    if i >= len(tokens):
+        tokens.extend([u''] * (i + 1 - len(tokens)))
+    tokens[i] = token
+
+
+def ucfirst(token):
+    first = token[:1]
+    return FULL_TITLE.get(first, first.title()) + token[1:]
+
+
+def uc(token):
+    return RE_FULL_UPPER.sub(lambda m: FULL_UPPER[m.group(0)], token).upper()
+
+
+def split_lower(text):
+    """Tokens of a line and their lowercased forms. lc() is only used if
+    the line needs a full case mapping."""
+    tokens = perl_split(text)
+    if RE_FULL_LOWER.search(text):
+        return tokens, [lc(token) for token in tokens]
+    return tokens, [token.lower() for token in tokens]
+
+
+def lc(token):
+    return RE_FULL_LOWER.sub(lambda m: FULL_LOWER[m.group(0)], token).lower()
+
+
+def starts_upper(token):
+    return bool(token) and unicodedata.category(token[0]) == 'Lu'
+
+
+def is_capitalized(token):
+    return len(token) > 1 and starts_upper(token) \
+        and all(unicodedata.category(c) in ('Ll', 'Nd') for c in token[1:])
+
+
+def is_uppercased(token):
+    return len(token) > 1 and starts_upper(token) \
+        and all(unicodedata.category(c) in ('Lu', 'Nd') for c in token[1:])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Restores casing and tokenization of decoded text.")
+    parser.add_argument("orig", help="original input file")
+    parser.add_argument("aln", help="word alignment file")
+    parser.add_argument(
+        "-j", "--jobs",
+        help="number of parallel jobs, default: 1",
+        type=int,
+        default=THREADS)
+    parser.add_argument(
+        "--chunk",
+        help="number of lines processed by a job at once",
+        type=int,
+        default=CHUNK_SIZE)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,43 +2,92 @@
 
 import re
 import sys
+import time
 import operator
+import itertools
 import subprocess
 import argparse
 import os
 
 from joblib import Parallel, delayed
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from m2_corpus import M2Corpus
 from diff_finder import edited_tokens
 from detokenize import detokenize_nltk
+from moses_tokenizer import MosesTokenizer, MosesDetokenizer, process_lines
 
 
 MOSES_TOK = "%s/scripts/tokenizer/tokenizer.perl 2> /dev/null"
 MOSES_DETOK = "%s/scripts/tokenizer/detokenizer.perl 2> /dev/null"
+TOKENIZER = None
+DETOKENIZER = None
+JOBS = 1
 DEBUG = False
 
 
 def main():
-    global MOSES_TOK, MOSES_DETOK, DEBUG
+    global MOSES_TOK, MOSES_DETOK, TOKENIZER, DETOKENIZER, JOBS, DEBUG
 
     args = parse_options()
     MOSES_TOK = "%s/scripts/tokenizer/tokenizer.perl -threads %i 2> /dev/null" % (args.moses, args.jobs)
     MOSES_DETOK = "%s/scripts/tokenizer/detokenizer.perl -threads %i 2> /dev/null" % (args.moses, args.jobs)
+    if args.tokenizer == 'python':
+        TOKENIZER = MosesTokenizer(moses=args.moses)
+        DETOKENIZER = MosesDetokenizer()
+    JOBS = args.jobs
     DEBUG = args.debug
 
-    moses_sentences = tokenize_file(args.m2_file)
+    corpus = M2Corpus(args.m2_file)
+    if args.shard:
+        k, n = [int(x) for x in args.shard.split('/')]
+        entries = corpus.sentences(corpus.shard(k, n))
+    else:
+        entries = iter(corpus)
+
+    if args.chunk:
+        convert_streaming(entries, args.chunk, args.jobs)
+        return
+
+    entries = list(entries)
+    moses_sentences = tokenize_lines(entry.text for entry in entries)
+    corrections = tokenize_corrections(
+        corr for entry in entries for corr in entry_corrections(entry))
 
     jobs = []
-    for entry, idx in each_m2_entry_with_index(args.m2_file):
-        jobs.append(delayed(convert_m2_tok)(entry, moses_sentences[idx]))
+    for entry, moses_sentence in zip(entries, moses_sentences):
+        jobs.append(delayed(convert_m2_tok)(
+            entry, moses_sentence, select_corrections(entry, corrections)))
 
     results = Parallel(n_jobs=args.jobs)(jobs)
     for entry in results:
         print entry
 
 
-def convert_m2_tok(entry, moses_sentence):
-    in_sent = entry['text']
+def convert_streaming(entries, chunk_size, n_jobs):
+    """Converts M2 sentences in chunks, so that memory usage is bounded by
+    the chunk size. Each chunk is tokenized with a single Moses call and
+    converted in parallel, and its output is printed right away."""
+    with Parallel(n_jobs=n_jobs) as parallel:
+        while True:
+            chunk = list(itertools.islice(entries, chunk_size))
+            if not chunk:
+                break
+            moses_sentences = tokenize_lines(entry.text for entry in chunk)
+            corrections = tokenize_corrections(
+                corr for entry in chunk for corr in entry_corrections(entry))
+
+            results = parallel(
+                delayed(convert_m2_tok)(entry, moses_sentence,
+                                        select_corrections(entry, corrections))
+                for entry, moses_sentence in zip(chunk, moses_sentences))
+            for entry in results:
+                print entry
+            sys.stdout.flush()
+
+def convert_m2_tok(entry, moses_sentence, corrections=None):
+    in_sent = entry.text
     out_sent = normalize_negations(moses_sentence)
 
     debug(entry)
@@ -47,20 +96,21 @@ def convert_m2_tok(entry, moses_sentence):
     output = "S %s\n" % out_sent
 
     if in_sent == out_sent:
-        for mistake in entry['mistakes']:
-            output += format_mistake(mistake) + "\n"
+        for mistake in entry.edits:
+            output += format_mistake(mistake, corrections=corrections) + "\n"
         return output
 
     diffs = edited_tokens(in_sent.split(' '), out_sent.split(' '))
-    maps = mapping(diffs, entry['mistakes'])
+    maps = mapping(diffs, entry.edits)
 
     debug(diffs, "\n")
     debug(maps, "\n")
 
     idx = 0
-    for mistake in entry['mistakes']:
+    for mistake in entry.edits:
         nrm_mistake = normalize_mistake(mistake, in_sent)
-        output += format_mistake(nrm_mistake, maps[idx][2], maps[idx][3]) + "\n"
+        output += format_mistake(nrm_mistake, maps[idx][2], maps[idx][3],
+                                 corrections) + "\n"
         idx += 1
 
     return output
@@ -109,90 +159,110 @@ def diff_mapping(diffs):
     return maps
 
 def mistake_mapping(mistakes):
-    return [(m['start_pos'], m['end_pos'], None, None) for m in mistakes]
-
+    return [(m.start, m.end, None, None) for m in mistakes]
+
+
+def tokenize_lines(lines):
+    if TOKENIZER:
+        return list(process_lines(moses_tokenize, lines, JOBS))
+    lines = list(lines)
+    proc = subprocess.Popen("%s | %s" % (MOSES_DETOK, MOSES_TOK), shell=True,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output = proc.communicate(input=''.join(line + '\n' for line in lines))[0]
+    output = output.split('\n')[:len(lines)]
+    if proc.returncode != 0 or len(output) < len(lines):
+        raise RuntimeError("Tokenization of sentences failed")
+    return output
 
-def tokenize_file(file_name):
-    debug("Detokenize/tokenize with Moses")
-    cmd = "cat %s | grep '^S ' | cut -c3- | %s | %s" % (file_name, MOSES_DETOK, MOSES_TOK)
-    output = subprocess.check_output(cmd, shell=True)
-    return output.strip().split('\n')
+def moses_tokenize(line):
+    """Detokenizes and tokenizes a line in-process, as MOSES_DETOK | MOSES_TOK."""
+    return TOKENIZER.tokenize(DETOKENIZER.detokenize(line))
 
-def format_mistake(mis, start_pos=None, end_pos=None):
+def format_mistake(mis, start_pos=None, end_pos=None, corrections=None):
     if not start_pos:
-        start_pos = mis['start_pos']
+        start_pos = mis.start
     if not end_pos:
-        end_pos = mis['end_pos']
+        end_pos = mis.end
 
-    corr = tokenize_corr(mis['correction'])
+    corr = tokenize_corr(mis.correction, corrections)
 
     return "A %i %i|||%s|||%s|||%s|||%s|||%s" % (start_pos, end_pos,
-                                                 mis['category'], corr, mis['required'],
-                                                 mis['comment'], mis['annotator_id'])
-def tokenize_corr(corr):
+                                                 mis.category, corr, mis.required,
+                                                 mis.comment, mis.annotator)
+def tokenize_corr(corr, corrections=None):
     if not corr:
         return ''
     if re.match(r"^[a-z]+$", corr, re.IGNORECASE):
         return tokenize_puncts(corr)
+    if corrections and corr in corrections:
+        return corrections[corr]
     corr = detokenize_nltk(tokenize_puncts(corr))
+    if TOKENIZER:
+        return TOKENIZER.tokenize(corr.strip()).strip()
     proc = subprocess.Popen(MOSES_TOK, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
     return proc.communicate(input=corr.strip())[0].strip()
 
+def needs_moses(corr):
+    return corr and not re.match(r"^[a-z]+$", corr, re.IGNORECASE)
+
+def entry_corrections(entry):
+    """Yields correction strings of the entry that are tokenized with Moses,
+    including corrections changed by normalize_mistake()."""
+    for mistake in entry.edits:
+        for corr in (mistake.correction,
+                     normalize_mistake(mistake, entry.text).correction):
+            if needs_moses(corr):
+                yield corr
+
+def select_corrections(entry, corrections):
+    return dict((corr, corrections[corr]) for corr in entry_corrections(entry)
+                if corr in corrections)
+
+def tokenize_corrections(corrs):
+    """Tokenizes distinct correction strings with a single Moses call, one
+    string per line, and returns a dictionary of results."""
+    start = time.time()
+    total = 0
+    unique = []
+    seen = set()
+    for corr in corrs:
+        total += 1
+        if corr not in seen:
+            seen.add(corr)
+            unique.append(corr)
+    if not unique:
+        return {}
+
+    lines = [detokenize_nltk(tokenize_puncts(corr)).strip() for corr in unique]
+    if TOKENIZER:
+        output = [TOKENIZER.tokenize(line) for line in lines]
+    else:
+        proc = subprocess.Popen(MOSES_TOK, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        output = proc.communicate(input='\n'.join(lines) + '\n')[0].split('\n')
+        if proc.returncode != 0 or len(output) < len(lines):
+            raise RuntimeError("Tokenization of corrections failed")
+
+    print >>sys.stderr, "Tokenized %i corrections (%i distinct) in %.2fs" \
+        % (total, len(unique), time.time() - start)
+    return dict((corr, tok.strip()) for corr, tok in zip(unique, output))
+
 
 def normalize_mistake(mistake, sent):
     mis = mistake.copy()
-    start, end = mis['start_pos'], mis['end_pos']
+    start, end = mis.start, mis.end
     toks = sent.split(' ')
 
     if end < len(toks) and start+1 == end:
         tok = toks[start:end][0]
         next_tok = toks[start+1:end+1][0]
         if next_tok == "n't" and not tok.endswith('n'):
-            mis['correction'] += 'n'
+            mis.correction += 'n'
 
     return mis
 
 def tokenize_puncts(text):
     return re.sub(r'([a-z]*)\s*([;:,.?!]+)\s*([a-z]*)', r'\1 \2 \3', text).strip()
 
-def each_m2_entry_with_index(m2_fname):
-    idx = 0
-    for entry in each_m2_entry(m2_fname):
-        yield entry, idx
-        idx += 1
-
-def each_m2_entry(m2_fname):
-    m2_file = open(m2_fname)
-    sentence = {}
-
-    for line in m2_file:
-        if line.startswith('S '):
-            text = line.strip()[2:]
-            sentence = {'text': text, 'mistakes': []}
-
-        elif line.startswith('A '):
-            mistake = {'line': line.strip()}
-
-            mistake['offsets'], \
-            mistake['category'], \
-            mistake['correction'], \
-            mistake['required'], \
-            mistake['comment'], \
-            mistake['annotator_id'] = line.strip()[2:].split('|||')
-
-            mistake['start_pos'], mistake['end_pos'] = \
-                [int(pos) for pos in mistake['offsets'].split()]
-
-            sentence['mistakes'].append(mistake)
-
-        elif not line.strip():
-            yield sentence
-            sentence = {}
-    if sentence:
-        yield sentence
-
-    m2_file.close()
-
 def debug(*args):
     if DEBUG:
         for arg in args:
@@ -206,6 +276,9 @@ def parse_options():
     parser.add_argument("-m", "--moses", help="Path to Moses directory", required=True)
     parser.add_argument("-d", "--debug", help="Print debug messages", action='store_true')
     parser.add_argument("-j", "--jobs", help="Number of parallel jobs", type=int, default=16)
+    parser.add_argument("-t", "--tokenizer", help="Tokenize with the Perl scripts or in-process with moses_tokenizer.py", choices=['perl', 'python'], default='perl')
+    parser.add_argument("-s", "--shard", help="Convert only the k-th of n shards of sentences, given as k/n")
+    parser.add_argument("-c", "--chunk", help="Convert and print in chunks of this many sentences", type=int)
     return parser.parse_args()
 
 if __name__ == "__main__":
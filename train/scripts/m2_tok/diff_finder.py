@@ -1,7 +1,150 @@
 import re
-from difflib import ndiff, restore
+import sys
+import time
+from difflib import ndiff, restore, SequenceMatcher, IS_CHARACTER_JUNK
 
 def edited_tokens(new_tokens, old_tokens):
+    """Returns (old_edit, new_edit, start, end) tuples for each edited span,
+    exactly as edited_tokens_ndiff(), but computed from the opcodes of
+    SequenceMatcher without building and parsing a full ndiff transcript."""
+    if new_tokens == old_tokens:
+        return []
+    try:
+        diffs = list(__diff_tags(new_tokens, old_tokens, {}))
+    except:
+        return []
+
+    edits = []
+    pos_shift = 0
+    i = 0
+    while i < len(diffs):
+        if diffs[i][0] == ' ':
+            i += 1
+            continue
+        start = i
+        minus = []
+        plus = []
+        while i < len(diffs) and diffs[i][0] == '-':
+            minus.append(diffs[i][1])
+            i += 1
+        while i < len(diffs) and diffs[i][0] == '+':
+            plus.append(diffs[i][1])
+            i += 1
+        start_pos = start - pos_shift
+        pos_shift += len(plus)
+        edits.append( (' '.join(minus), ' '.join(plus),
+                       start_pos, start_pos + len(minus)) )
+
+    return edits
+
+def __diff_tags(a, b, ratios):
+    """Yields (tag, token) pairs of ndiff(a, b) without the '?' lines."""
+    for tag, alo, ahi, blo, bhi in SequenceMatcher(None, a, b).get_opcodes():
+        if tag == 'replace':
+            for item in __fancy_replace(a, alo, ahi, b, blo, bhi, ratios):
+                yield item
+        elif tag == 'delete':
+            for i in xrange(alo, ahi):
+                yield '-', '%s' % a[i]
+        elif tag == 'insert':
+            for j in xrange(blo, bhi):
+                yield '+', '%s' % b[j]
+        else:
+            for i in xrange(alo, ahi):
+                yield ' ', '%s' % a[i]
+
+def __fancy_replace(a, alo, ahi, b, blo, bhi, ratios):
+    """Pairs similar tokens of a replaced block like Differ._fancy_replace,
+    skipping the intraline markup. Token pairs that can be used as a synch
+    point are found once for the whole block, so that the recursion only
+    scans these instead of all pairs."""
+    best_ratio = 0.74
+    positions = {}
+    for i in xrange(alo, ahi):
+        positions.setdefault(a[i], []).append(i)
+
+    # similar tokens are found for distinct tokens only
+    similar = {}
+    for bj in set(b[blo:bhi]):
+        similar[bj] = []
+        for ai in positions:
+            if ai == bj:
+                similar[bj].append((ai, None))
+                continue
+            # upper bound of the ratio given by the lengths, as
+            # real_quick_ratio(); ratio() never exceeds it
+            length = len(ai) + len(bj)
+            if 2.0 * min(len(ai), len(bj)) / length <= best_ratio:
+                continue
+            ratio = ratios.get((ai, bj))
+            if ratio is None:
+                ratio = SequenceMatcher(IS_CHARACTER_JUNK, ai, bj).ratio()
+                ratios[ai, bj] = ratio
+            if ratio > best_ratio:
+                similar[bj].append((ai, ratio))
+
+    pairs = []
+    for j in xrange(blo, bhi):
+        row = sorted((i, ratio) for ai, ratio in similar[b[j]]
+                     for i in positions[ai])
+        pairs.extend((j, i, ratio) for i, ratio in row)
+
+    return __fancy_pairs(a, alo, ahi, b, blo, bhi, pairs)
+
+def __fancy_pairs(a, alo, ahi, b, blo, bhi, pairs):
+    best_ratio, cutoff = 0.74, 0.75
+    eqi, eqj = None, None
+
+    # pairs are in the order in which Differ._fancy_replace compares them
+    pairs = [pair for pair in pairs
+             if blo <= pair[0] < bhi and alo <= pair[1] < ahi]
+    for j, i, ratio in pairs:
+        if ratio is None:
+            if eqi is None:
+                eqi, eqj = i, j
+        elif ratio > best_ratio:
+            best_ratio, best_i, best_j = ratio, i, j
+
+    if best_ratio < cutoff:
+        if eqi is None:
+            if bhi - blo < ahi - alo:
+                order = [('+', b, blo, bhi), ('-', a, alo, ahi)]
+            else:
+                order = [('-', a, alo, ahi), ('+', b, blo, bhi)]
+            for tag, x, lo, hi in order:
+                for i in xrange(lo, hi):
+                    yield tag, '%s' % x[i]
+            return
+        best_i, best_j = eqi, eqj
+    else:
+        eqi = None
+
+    for item in __fancy_helper(a, alo, best_i, b, blo, best_j, pairs):
+        yield item
+
+    if eqi is None:
+        yield '-', '%s' % a[best_i]
+        yield '+', '%s' % b[best_j]
+    else:
+        yield ' ', '%s' % a[best_i]
+
+    for item in __fancy_helper(a, best_i + 1, ahi, b, best_j + 1, bhi, pairs):
+        yield item
+
+def __fancy_helper(a, alo, ahi, b, blo, bhi, pairs):
+    if alo < ahi:
+        if blo < bhi:
+            for item in __fancy_pairs(a, alo, ahi, b, blo, bhi, pairs):
+                yield item
+        else:
+            for i in xrange(alo, ahi):
+                yield '-', '%s' % a[i]
+    elif blo < bhi:
+        for j in xrange(blo, bhi):
+            yield '+', '%s' % b[j]
+
+def edited_tokens_ndiff(new_tokens, old_tokens):
+    """Reference implementation parsing the output of difflib.ndiff."""
     try:
         raw_diff = ndiff(new_tokens, old_tokens)
     except:
@@ -48,3 +191,32 @@ def __clean_diff(diff):
 
 def __diff_actions(diffs):
     return ''.join([line[0] for line in diffs])
+
+def compare(new_file, old_file):
+    """Checks that both implementations give the same edits for aligned
+    tokenized sentences and reports their speed."""
+    with open(new_file) as new_io, open(old_file) as old_io:
+        pairs = [(new.strip().split(' '), old.strip().split(' '))
+                 for new, old in zip(new_io, old_io)]
+
+    times = []
+    results = []
+    for func in (edited_tokens_ndiff, edited_tokens):
+        start = time.time()
+        results.append([func(new, old) for new, old in pairs])
+        times.append(time.time() - start)
+
+    diffs = sum(1 for ref, out in zip(*results) if ref != out)
+    tokens = sum(len(new) for new, _ in pairs)
+    print "Sentences: %i, tokens: %i, different results: %i" \
+        % (len(pairs), tokens, diffs)
+    print "ndiff: %.2fs, opcodes: %.2fs (%.1fx faster)" \
+        % (times[0], times[1], times[0] / max(times[1], 1e-6))
+    return diffs == 0
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print "Compares edited_tokens() with the ndiff-based implementation."
+        print "usage: python diff_finder.py nltk-tok.txt moses-tok.txt"
+        exit(0)
+    exit(0 if compare(sys.argv[1], sys.argv[2]) else 1)
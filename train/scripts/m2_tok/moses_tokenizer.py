@@ -0,0 +1,492 @@
+#!/usr/bin/python
+# -*- encoding: utf-8 -*-
+"""
+Moses tokenizer and detokenizer reimplemented in Python, so that they can be
+called in-process instead of piping text through tokenizer.perl and
+detokenizer.perl. The output is the same as from the Perl scripts with their
+default options, including escaping of special characters. Nonbreaking
+prefixes are read from the Moses directory.
+
+Perl character classes like \\p{IsAlpha} are built from the unicodedata
+module, which matches Perl for letters, digits and punctuation, but may
+differ for a few combining marks of non-Latin scripts.
+
+usage: ./moses_tokenizer.py [-l en] [-threads 16] < input.txt > input.tok
+       ./moses_tokenizer.py -detokenize < input.tok > input.txt
+       ./moses_tokenizer.py -check ../../../jfleg/*.out
+"""
+
+import re
+import sys
+import time
+import argparse
+import itertools
+import subprocess
+import multiprocessing
+import unicodedata
+
+MOSES = "/data/smt/mosesdecoder"
+THREADS = 1
+CHUNK_SIZE = 1000
+
+# whitespace matched by \s in Perl
+WHITESPACE = u'\t\n\x0b\x0c\r \x85\xa0\u1680\u2000-\u200a\u2028\u2029' \
+             u'\u202f\u205f\u3000'
+
+# combining marks that are not alphabetic in Perl
+DIACRITIC_BLOCKS = [(0x0300, 0x036f), (0x0483, 0x0489), (0x1dc0, 0x1dff),
+                    (0x20d0, 0x20ff), (0xfe20, 0xfe2f), (0x302a, 0x302f),
+                    (0x3099, 0x309a)]
+OTHER_LOWERCASE = [(0x00aa, 0x00aa), (0x00ba, 0x00ba), (0x02b0, 0x02b8),
+                   (0x02c0, 0x02c1), (0x02e0, 0x02e4), (0x0345, 0x0345),
+                   (0x037a, 0x037a), (0x2170, 0x217f), (0x24d0, 0x24e9)]
+CIRCLED_LETTERS = [(0x24b6, 0x24e9)]
+
+CJK_RANGES = [(0x1100, 0x11ff), (0x2e80, 0xa4cf), (0xa840, 0xa87f),
+              (0xac00, 0xd7af), (0xf900, 0xfaff), (0xfe30, 0xfe4f),
+              (0xff65, 0xffdc), (0x20000, 0x2ffff)]
+
+ESCAPES = [(u'&', u'&amp;'), (u'|', u'&#124;'), (u'<', u'&lt;'),
+           (u'>', u'&gt;'), (u"'", u'&apos;'), (u'"', u'&quot;'),
+           (u'[', u'&#91;'), (u']', u'&#93;')]
+UNESCAPES = {
+    u'&bar;': u'|',
+    u'&#124;': u'|',
+    u'&lt;': u'<',
+    u'&gt;': u'>',
+    u'&bra;': u'[',
+    u'&ket;': u']',
+    u'&quot;': u'"',
+    u'&apos;': u"'",
+    u'&#91;': u'[',
+    u'&#93;': u']',
+    u'&amp;': u'&',
+}
+
+
+def char_classes():
+    """Returns contents of regex character classes for the Perl properties
+    IsAlpha, IsAlnum, IsN, IsLower and IsSc."""
+    members = dict((name, []) for name in ('alpha', 'alnum', 'n', 'lower',
+                                           'sc'))
+    # planes above 2 contain only tags, variation selectors and private use
+    # characters, which are in none of the classes
+    last = min(sys.maxunicode, 0x2ffff)
+    for cp in xrange(last + 1):
+        char = unichr(cp)
+        cat = unicodedata.category(char)
+        if cat == 'Cn':
+            continue
+        alpha = cat[0] == 'L' or cat == 'Nl' \
+            or (cat in ('Mn', 'Mc') and is_alphabetic_mark(char)) \
+            or in_ranges(cp, CIRCLED_LETTERS)
+        if alpha:
+            members['alpha'].append(cp)
+        if alpha or cat == 'Nd':
+            members['alnum'].append(cp)
+        if cat[0] == 'N':
+            members['n'].append(cp)
+        if cat == 'Ll' or in_ranges(cp, OTHER_LOWERCASE) \
+                or (cat == 'Lm' and 'SMALL' in unicodedata.name(char, '')):
+            members['lower'].append(cp)
+        if cat == 'Sc':
+            members['sc'].append(cp)
+    return dict((name, class_ranges(cps)) for name, cps in members.items())
+
+
+def is_alphabetic_mark(char):
+    """Vowel signs and other marks of letters are alphabetic, while
+    diacritics, viramas and nuktas are not."""
+    if char == u'\u0345':
+        return True
+    if in_ranges(ord(char), DIACRITIC_BLOCKS):
+        return False
+    name = unicodedata.name(char, '')
+    return 'VIRAMA' not in name and 'NUKTA' not in name
+
+
+def in_ranges(cp, ranges):
+    return any(lo <= cp <= hi for lo, hi in ranges)
+
+
+def class_ranges(cps):
+    """Formats sorted code points as ranges of a regex character class."""
+    ranges = []
+    for _, group in itertools.groupby(enumerate(cps), lambda (i, cp): cp - i):
+        group = [cp for _, cp in group]
+        ranges.append(class_char(group[0]) if len(group) == 1 else
+                      class_char(group[0]) + u'-' + class_char(group[-1]))
+    return u''.join(ranges)
+
+
+def class_char(cp):
+    char = unichr(cp)
+    return u'\\' + char if char in u'\\]^-' else char
+
+
+CLASSES = char_classes()
+ALPHA = CLASSES['alpha']
+ALNUM = CLASSES['alnum']
+NUMBER = CLASSES['n']
+LOWER = CLASSES['lower']
+CURRENCY = CLASSES['sc']
+
+RE_BLANK = re.compile(u'^[%s]*$' % WHITESPACE)
+RE_SPACES = re.compile(u' +')
+
+
+class MosesTokenizer(object):
+    """Tokenizes like tokenizer.perl. Rules are compiled once."""
+
+    def __init__(self, lang='en', moses=MOSES, escape=True, aggressive=False):
+        self.lang = lang
+        self.escape = escape
+        self.aggressive = aggressive
+        self.prefixes = load_prefixes(moses, lang)
+
+        self.whitespace = re.compile(u'[%s]+' % WHITESPACE)
+        self.junk = re.compile(u'[\x00-\x1f]')
+        self.special = re.compile(u"([^%s .'`,\\-])" % ALNUM)
+        self.hyphen = re.compile(u'([%s])-(?=[%s])' % (ALNUM, ALNUM))
+        self.dots = re.compile(u'\\.(\\.+)')
+        self.dotmulti = re.compile(u'DOTMULTI\\.([^.])')
+        self.commas = [
+            (re.compile(u'([^%s]),' % NUMBER), u'\\1 , '),
+            (re.compile(u',([^%s])' % NUMBER), u' , \\1'),
+        ]
+
+        na, a, n = u'[^%s]' % ALPHA, u'[%s]' % ALPHA, u'[%s]' % NUMBER
+        if lang == 'en':
+            rules = [
+                (u"(%s)'(%s)" % (na, na), u"\\1 ' \\2"),
+                (u"([^%s%s])'(%s)" % (ALPHA, NUMBER, a), u"\\1 ' \\2"),
+                (u"(%s)'(%s)" % (a, na), u"\\1 ' \\2"),
+                (u"(%s)'(%s)" % (a, a), u"\\1 '\\2"),
+                (u"(%s)'(s)" % n, u"\\1 '\\2"),
+            ]
+        elif lang in ('fr', 'it'):
+            rules = [
+                (u"(%s)'(%s)" % (na, na), u"\\1 ' \\2"),
+                (u"(%s)'(%s)" % (na, a), u"\\1 ' \\2"),
+                (u"(%s)'(%s)" % (a, na), u"\\1 ' \\2"),
+                (u"(%s)'(%s)" % (a, a), u"\\1' \\2"),
+            ]
+        else:
+            rules = [(u"'", u" ' ")]
+        self.apostrophes = [(re.compile(pattern), repl)
+                            for pattern, repl in rules]
+
+        self.alpha = re.compile(u'[%s]' % ALPHA)
+        self.lower = re.compile(u'[%s]' % LOWER)
+        self.digits = re.compile(u'[0-9]')
+
+    def tokenize(self, text):
+        """Tokenizes a line given as a UTF-8 or a unicode string."""
+        if isinstance(text, str):
+            return self.tokenize(text.decode('utf-8', 'replace')) \
+                .encode('utf-8')
+        if text.endswith(u'\n'):
+            text = text[:-1]
+        if RE_BLANK.match(text):
+            return text
+
+        text = self.whitespace.sub(u' ', u' %s ' % text)
+        text = squeeze(self.junk.sub(u'', text))
+
+        text = self.special.sub(u' \\1 ', text)
+        if self.aggressive:
+            text = self.hyphen.sub(u'\\1 @-@ ', text)
+
+        # multiple dots stay together
+        if u'..' in text:
+            text = self.dots.sub(u' DOTMULTI\\1', text)
+        while u'DOTMULTI.' in text:
+            text = self.dotmulti.sub(u'DOTDOTMULTI \\1', text)
+            text = text.replace(u'DOTMULTI.', u'DOTDOTMULTI')
+
+        # rules are skipped for sentences without the characters they split
+        if u',' in text:
+            # commas are separated unless within numbers
+            for regex, repl in self.commas:
+                text = regex.sub(repl, text)
+        if u"'" in text:
+            for regex, repl in self.apostrophes:
+                text = regex.sub(repl, text)
+
+        words = text.split(u' ')
+        for i, word in enumerate(words):
+            if len(word) > 1 and word.endswith(u'.'):
+                words[i] = self.split_period(word[:-1], words[i + 1:i + 2])
+        text = squeeze(u' '.join(words))
+
+        while u'DOTDOTMULTI' in text:
+            text = text.replace(u'DOTDOTMULTI', u'DOTMULTI.')
+        text = text.replace(u'DOTMULTI', u'.')
+
+        if self.escape:
+            for char, escaped in ESCAPES:
+                if char in text:
+                    text = text.replace(char, escaped)
+        return text
+
+    def split_period(self, pre, following):
+        """Separates the final period of a word unless it is a nonbreaking
+        prefix, an acronym, or followed by a lowercased word."""
+        prefix = self.prefixes.get(pre)
+        if (u'.' in pre and self.alpha.search(pre)) or prefix == 1:
+            return pre + u'.'
+        if following and self.lower.match(following[0]):
+            return pre + u'.'
+        if prefix == 2 and following and self.digits.match(following[0]):
+            return pre + u'.'
+        return pre + u' .'
+
+    def tokenize_lines(self, lines, jobs=THREADS):
+        return process_lines(self.tokenize, lines, jobs)
+
+
+class MosesDetokenizer(object):
+    """Detokenizes like detokenizer.perl, with rules for English, French and
+    Italian."""
+
+    def __init__(self, lang='en'):
+        self.lang = lang
+        self.unescapes = re.compile(u'|'.join(re.escape(entity)
+                                              for entity in UNESCAPES))
+        self.tag = re.compile(u'^<.+>$')
+        self.opening = re.compile(u'^[%s([{\xbf\xa1]+$' % CURRENCY)
+        self.closing = re.compile(u'^[,.?!:;\\\\%}\\])]+$')
+        self.french = re.compile(u'^[?!:;\\\\%]$')
+        self.quotes = re.compile(u'^[\'"„“`]+$')
+        self.low_quotes = re.compile(u'^[„“”]+$')
+        self.starts_alpha = re.compile(u'[%s]' % ALPHA)
+        self.ends_alpha = re.compile(u'[%s]$' % ALPHA)
+        self.ends_alnum = re.compile(u'[%s]$' % ALNUM)
+        self.elision = re.compile(u"[%s]'$" % ALPHA)
+        self.contraction = re.compile(u"'[%s]" % ALPHA)
+
+    def detokenize(self, text):
+        """Detokenizes a line given as a UTF-8 or a unicode string."""
+        if isinstance(text, str):
+            return self.detokenize(text.decode('utf-8', 'replace')) \
+                .encode('utf-8')
+        if text.endswith(u'\n'):
+            text = text[:-1]
+        if self.tag.match(text) or RE_BLANK.match(text):
+            return text
+
+        text = u' %s ' % text
+        text = text.replace(u' @-@ ', u'-')
+        if u'&' in text:
+            text = self.unescapes.sub(lambda m: UNESCAPES[m.group(0)], text)
+
+        words = text.split(u' ')
+        # split(/ /) in Perl drops trailing empty fields
+        while words and not words[-1]:
+            words.pop()
+
+        output = []
+        quotes = {}
+        space = u' '
+        for i, word in enumerate(words):
+            if starts_cjk(word):
+                if i > 0 and ends_cjk(words[i - 1]):
+                    output.append(word)
+                else:
+                    output.extend((space, word))
+                space = u' '
+            elif self.opening.match(word):
+                output.extend((space, word))
+                space = u''
+            elif self.closing.match(word):
+                if self.lang == 'fr' and self.french.match(word):
+                    output.append(u' ')
+                output.append(word)
+                space = u' '
+            elif self.lang == 'en' and i > 0 and self.contraction.match(word) \
+                    and self.ends_alnum.search(words[i - 1]):
+                output.append(word)
+                space = u' '
+            elif self.lang in ('fr', 'it') and i <= len(words) - 2 \
+                    and self.elision.search(word) \
+                    and self.starts_alpha.match(words[i + 1]):
+                output.extend((space, word))
+                space = u''
+            elif self.quotes.match(word):
+                quote = u'"' if self.low_quotes.match(word) else word
+                count = quotes.get(quote, 0)
+                if count % 2 == 0:
+                    if self.lang == 'en' and word == u"'" and i > 0 \
+                            and words[i - 1].endswith(u's'):
+                        output.append(word)
+                        space = u' '
+                    else:
+                        output.extend((space, word))
+                        space = u''
+                        quotes[quote] = count + 1
+                else:
+                    output.append(word)
+                    space = u' '
+                    quotes[quote] = count + 1
+            else:
+                output.extend((space, word))
+                space = u' '
+
+        return squeeze(u''.join(output))
+
+    def detokenize_lines(self, lines, jobs=THREADS):
+        return process_lines(self.detokenize, lines, jobs)
+
+
+def load_prefixes(moses, lang):
+    """Reads nonbreaking prefixes of tokenizer.perl: 1 for prefixes, 2 for
+    prefixes followed only by numbers."""
+    path = "%s/scripts/share/nonbreaking_prefixes/nonbreaking_prefix.%s"
+    try:
+        prefix_io = open(path % (moses, lang))
+    except IOError:
+        print >> sys.stderr, "WARNING: No known abbreviations for language" \
+            " '%s', attempting fall-back to English version..." % lang
+        prefix_io = open(path % (moses, 'en'))
+
+    prefixes = {}
+    with prefix_io:
+        for line in prefix_io:
+            item = line.decode('utf-8').rstrip(u'\n')
+            if not item or item == u'0' or item.startswith(u'#'):
+                continue
+            match = re.search(u'(.*)\\s+#NUMERIC_ONLY#', item, re.UNICODE)
+            if match:
+                prefixes[match.group(1)] = 2
+            else:
+                prefixes[item] = 1
+    return prefixes
+
+
+def squeeze(text):
+    """Collapses spaces and removes a leading and a trailing one."""
+    if u'  ' in text:
+        text = RE_SPACES.sub(u' ', text)
+    if text.startswith(u' '):
+        text = text[1:]
+    if text.endswith(u' '):
+        text = text[:-1]
+    return text
+
+
+def starts_cjk(word):
+    return bool(word) and in_ranges(ord(word[0]), CJK_RANGES)
+
+
+def ends_cjk(word):
+    return bool(word) and in_ranges(ord(word[-1]), CJK_RANGES)
+
+
+_process_line = None
+
+
+def process_chunk(lines):
+    return [_process_line(line) for line in lines]
+
+
+def process_lines(func, lines, jobs=THREADS, chunk_size=CHUNK_SIZE):
+    """Applies func to each line, in forked worker processes if jobs > 1 as
+    tokenizer.perl -threads does, and yields results in the input order."""
+    global _process_line
+    if jobs <= 1:
+        for line in lines:
+            yield func(line)
+        return
+
+    _process_line = func
+    chunks = iter(lambda: list(itertools.islice(lines, chunk_size)), [])
+    pool = multiprocessing.Pool(jobs)
+    for chunk in pool.imap(process_chunk, chunks):
+        for line in chunk:
+            yield line
+    pool.close()
+    pool.join()
+
+
+def check(paths, args):
+    """Compares the output with tokenizer.perl and detokenizer.perl on the
+    given files and reports the speed of both."""
+    tokenizer = MosesTokenizer(args.l, args.moses, not args.no_escape,
+                               args.a)
+    detokenizer = MosesDetokenizer(args.l)
+    perl_tok = "%s/scripts/tokenizer/tokenizer.perl -q -l %s%s%s" \
+        % (args.moses, args.l, " -no-escape" if args.no_escape else "",
+           " -a" if args.a else "")
+    perl_detok = "%s/scripts/tokenizer/detokenizer.perl -q -l %s" \
+        % (args.moses, args.l)
+
+    passed = True
+    for path in paths:
+        with open(path) as text_io:
+            lines = [line.rstrip('\n') for line in text_io]
+        for name, func, cmd in (("tokenizer", tokenizer.tokenize, perl_tok),
+                                ("detokenizer", detokenizer.detokenize,
+                                 perl_detok)):
+            start = time.time()
+            proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE)
+            output = proc.communicate(''.join(l + '\n' for l in lines))[0]
+            if proc.returncode != 0:
+                raise RuntimeError("Command failed: %s" % cmd)
+            expected = output.split('\n')[:len(lines)]
+            perl_time = time.time() - start
+
+            start = time.time()
+            results = [func(line) for line in lines]
+            python_time = time.time() - start
+
+            diffs = [(line, exp, res) for line, exp, res
+                     in zip(lines, expected, results) if exp != res]
+            print "%s %s: %i lines, %i different, perl: %.2fs," \
+                " python: %.2fs" % (path, name, len(lines), len(diffs),
+                                    perl_time, python_time)
+            for line, exp, res in diffs[:5]:
+                print "  input:  %s\n  perl:   %s\n  python: %s" \
+                    % (line, exp, res)
+            passed = passed and not diffs
+    return passed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Tokenizes or detokenizes text like the Moses scripts.")
+    parser.add_argument("-l", help="language, default: en", default='en')
+    parser.add_argument(
+        "-threads", help="number of parallel jobs, default: 1", type=int,
+        default=THREADS)
+    parser.add_argument(
+        "-a", help="aggressive hyphen splitting", action='store_true')
+    parser.add_argument(
+        "-no-escape", help="do not escape special characters",
+        action='store_true')
+    parser.add_argument(
+        "-detokenize", help="detokenize instead of tokenizing",
+        action='store_true')
+    parser.add_argument(
+        "-moses", help="path to Moses with nonbreaking prefixes",
+        default=MOSES)
+    parser.add_argument(
+        "-check", nargs='+', metavar="FILE",
+        help="compare output with the Perl scripts on the given files")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.check:
+        sys.exit(0 if check(args.check, args) else 1)
+
+    if args.detokenize:
+        func = MosesDetokenizer(args.l).detokenize
+    else:
+        func = MosesTokenizer(args.l, args.moses, not args.no_escape,
+                              args.a).tokenize
+    # readline does not wait for a full buffer when reading from pipes
+    for line in process_lines(func, iter(sys.stdin.readline, ''),
+                              args.threads):
+        sys.stdout.write(line + '\n')